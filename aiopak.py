@@ -0,0 +1,185 @@
+"""
+asyncio interface to .pak files, for use inside event loops.
+
+An AsyncPackageReader wraps a single PackageReader whose header, file table and name index are loaded once and then shared by all tasks.
+Everything that touches the disk or decompresses runs on a thread pool, at most max_concurrency jobs per package at a time:
+
+    async with await AsyncPackageReader.open("Foo.pak") as package:
+        meta = await package.read("Mods/Foo/meta.lsx")
+        async for file, data in package.contents(package.glob("Public/**/*.lsx")):
+            ...
+
+Cancelling a task waiting for a read drops the job if it has not started yet, a job that is already running finishes in the background but
+keeps counting against max_concurrency until it is done.
+"""
+
+import asyncio
+import collections
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+from pak import PackageReader, FileReader, PackagedFileInfo
+
+default_executor : ThreadPoolExecutor | None = None
+default_executor_lock = threading.Lock()
+
+def get_default_executor() -> ThreadPoolExecutor:
+    """Thread pool shared by all AsyncPackageReaders that are not given their own, created on first use"""
+    global default_executor
+    with default_executor_lock:
+        if default_executor is None:
+            default_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="aiopak")
+        return default_executor
+
+
+class AsyncPackageReader:
+    """
+    reader: the PackageReader all requests go through
+    file: the package file, closed together with the reader if given
+    executor: thread pool running the blocking work(default: get_default_executor())
+    max_concurrency: maximum number of jobs of this package running or queued on the executor at once
+
+    Use AsyncPackageReader.open() to open a package from a path.
+    """
+    def __init__(self, reader : PackageReader, file = None, executor : ThreadPoolExecutor | None = None, max_concurrency : int = 8):
+        self.reader : PackageReader = reader
+        self.file = file
+        self.executor : ThreadPoolExecutor = executor or get_default_executor()
+        self.max_concurrency : int = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def open(path : str, use_mmap : bool | None = None, executor : ThreadPoolExecutor | None = None, max_concurrency : int = 8) -> "AsyncPackageReader":
+        """Opens the package at path, reading its header, file table and name index on the executor"""
+        def load():
+            file = open(path, 'rb')
+            try:
+                reader = PackageReader(file, use_mmap=use_mmap)
+                reader.get_index()
+            except BaseException:
+                file.close()
+                raise
+            return reader, file
+        executor = executor or get_default_executor()
+        reader, file = await asyncio.wrap_future(executor.submit(load))
+        return AsyncPackageReader(reader, file, executor, max_concurrency)
+
+    async def run(self, fn, *args):
+        """Runs fn(*args) on the executor, within the concurrency limit of the package"""
+        await self.semaphore.acquire()
+        loop = asyncio.get_running_loop()
+        try:
+            future = self.executor.submit(fn, *args)
+        except BaseException:
+            self.semaphore.release()
+            raise
+        def release(_):
+            try:
+                loop.call_soon_threadsafe(self.semaphore.release)
+            except RuntimeError:
+                # the loop is already closed
+                pass
+        # release once the job is really over, not when the awaiting task is cancelled while it still runs
+        future.add_done_callback(release)
+        return await asyncio.wrap_future(future)
+
+    def get_file(self, file : str | FileReader | PackagedFileInfo) -> FileReader:
+        if isinstance(file, str):
+            return self.reader.open(file)
+        if isinstance(file, PackagedFileInfo):
+            return FileReader(file, self.reader)
+        return file
+
+    async def read(self, file : str | FileReader | PackagedFileInfo):
+        """
+        Returns the uncompressed contents of a file, given by path, FileReader or PackagedFileInfo.
+
+        Like FileReader.read(), this may be a memoryview into the package mapping or the solid block.
+        """
+        return await self.run(self.get_file(file).read)
+
+    async def contents(self, files = None, prefetch : int | None = None, batch_size : int = 256*1024):
+        """
+        Async iterator over (FileReader, uncompressed data) for files(paths, FileReaders or PackagedFileInfos, default: all files), in order.
+
+        Files are read in batches of about batch_size compressed plus uncompressed bytes through PackageReader.read_many, so neighbouring
+        small files share one read and one executor job. Up to prefetch batches(default: max_concurrency) are read ahead. Reads that are
+        still pending when the iteration is left are cancelled.
+        """
+        if files is None:
+            files = self.reader.files
+        prefetch = prefetch or self.max_concurrency
+
+        def read_batch(batch):
+            data = {id(file) : contents for file, contents in self.reader.read_many(batch, workers=1)}
+            return [(file, data[id(file)]) for file in batch]
+
+        def batches():
+            batch = []
+            size = 0
+            for file in files:
+                file = self.get_file(file)
+                batch.append(file)
+                size += file.info.size_on_disk + file.info.uncompressed_size
+                if size >= batch_size:
+                    yield batch
+                    batch = []
+                    size = 0
+            if batch:
+                yield batch
+
+        pending = collections.deque()
+        try:
+            for batch in batches():
+                pending.append(asyncio.ensure_future(self.run(read_batch, batch)))
+                if len(pending) >= prefetch:
+                    for result in await pending.popleft():
+                        yield result
+            while pending:
+                for result in await pending.popleft():
+                    yield result
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def __aiter__(self):
+        """Iterates over the FileReaders of all files, giving other tasks a chance to run every now and then"""
+        for i, file in enumerate(self.reader.files):
+            if i % 1024 == 1023:
+                await asyncio.sleep(0)
+            yield file
+
+    def __len__(self):
+        return len(self.reader.files)
+
+    def __contains__(self, name : str):
+        return name in self.reader
+
+    def find(self, name : str) -> FileReader | None:
+        return self.reader.find(name)
+
+    def glob(self, pattern : str) -> List[FileReader]:
+        return self.reader.glob(pattern)
+
+    def listdir(self, directory : str = "") -> List[str]:
+        return self.reader.listdir(directory)
+
+    async def close(self):
+        """Waits for the running jobs of this package, then releases the reader and closes the package file"""
+        for _ in range(self.max_concurrency):
+            await self.semaphore.acquire()
+        try:
+            def close():
+                self.reader.close()
+                if self.file is not None:
+                    self.file.close()
+            await asyncio.wrap_future(self.executor.submit(close))
+        finally:
+            for _ in range(self.max_concurrency):
+                self.semaphore.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
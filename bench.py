@@ -0,0 +1,312 @@
+"""
+Benchmarks for pak.py and mod.py on synthetic data.
+
+Generates .pak files(V15, V16 and V18) and modsettings.lsx files of configurable size, measures throughput, peak memory and startup time
+and stores the results as json, so that runs before and after a change can be compared:
+
+    python bench.py --output before.json
+    python bench.py --output after.json --compare before.json
+"""
+
+import os
+import json
+import platform
+import random
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+import lz4.block
+from ctypes import *
+from typing import List
+
+import pak
+import mod
+
+METHODS = {"none" : pak.CompressionMethod.NONE, "zlib" : pak.CompressionMethod.ZLIB, "lz4" : pak.CompressionMethod.LZ4}
+
+def compress(data : bytes, method : pak.CompressionMethod) -> bytes:
+    match method:
+        case pak.CompressionMethod.NONE:
+            return data
+        case pak.CompressionMethod.ZLIB:
+            return zlib.compress(data)
+        case pak.CompressionMethod.LZ4:
+            return lz4.block.compress(data, store_size=False)
+
+def write_pak(path : str, files, version : int = 18, flags : int = 0, priority : int = 0):
+    """
+    Writes a package containing files, an iterable of (name, data, CompressionMethod) tuples.
+
+    Only meant for generating test data: file data is written right after the header, followed by the LZ4 compressed file list.
+    """
+    header_type = pak.LSPKHeader15 if version == 15 else pak.LSPKHeader16
+    entry_type = pak.FileEntry18 if version == 18 else pak.FileEntry15
+    entries = []
+    with open(path, 'wb') as f:
+        f.write(b"\0" * (4 + sizeof(header_type)))
+        for name, data, method in files:
+            compressed = compress(data, method)
+            entry = entry_type()
+            entry.name = name.encode()
+            offset = f.tell()
+            if version == 18:
+                entry.offset_in_file_1 = offset & 0xffffffff
+                entry.offset_in_file_2 = offset >> 32
+            else:
+                entry.offset_in_file = offset
+                entry.crc = zlib.crc32(compressed)
+            entry.size_on_disk = len(compressed)
+            entry.uncompressed_size = len(data)
+            entry.flags = method.value
+            entries.append(entry)
+            f.write(compressed)
+        file_list = lz4.block.compress(b"".join(bytes(e) for e in entries), store_size=False)
+        file_list_offset = f.tell()
+        f.write(struct.pack("<II", len(entries), len(file_list)))
+        f.write(file_list)
+        header = header_type(version=version, file_list_offset=file_list_offset, file_list_size=8 + len(file_list), flags=flags, priority=priority)
+        if version != 15:
+            header.num_parts = 1
+        f.seek(0)
+        f.write(pak.PackageReader.MAGIC)
+        f.write(bytes(header))
+
+def synthetic_files(count : int, size : int, mix : dict[str, int], seed : int = 0):
+    """
+    Yields count (name, data, CompressionMethod) tuples with roughly size bytes of data each.
+
+    mix maps method names("none", "zlib", "lz4") to relative weights. The data is about half random and half repetitive, so that it compresses like typical game data.
+    """
+    rng = random.Random(seed)
+    methods = [METHODS[name] for name in mix]
+    weights = list(mix.values())
+    for i in range(count):
+        entry_size = max(1, int(size * rng.uniform(0.5, 1.5)))
+        pattern = rng.randbytes(32)
+        data = rng.randbytes(entry_size // 2) + (pattern * (entry_size // 64 + 1))[:entry_size - entry_size // 2]
+        method = rng.choices(methods, weights)[0]
+        yield f"Public/Bench/Stats/Generated/dir{i % 64}/file_{i:07d}.lsf", data, method
+
+def write_modsettings(path : str, num_mods : int, seed : int = 0):
+    """Writes a modsettings.lsx containing the base game module and num_mods generated ModuleShortDesc nodes"""
+    rng = random.Random(seed)
+    mods = ["""                        <node id="ModuleShortDesc">
+                            <attribute id="Folder" type="LSString" value="GustavDev"/>
+                            <attribute id="MD5" type="LSString" value=""/>
+                            <attribute id="Name" type="LSString" value="GustavDev"/>
+                            <attribute id="UUID" type="FixedString" value="28ac9ce2-2aba-8cda-b3b5-6e922f71b6b8"/>
+                            <attribute id="Version64" type="int64" value="36028797018963968"/>
+                        </node>"""]
+    for i in range(num_mods):
+        mods.append(f"""                        <node id="ModuleShortDesc">
+                            <attribute id="Folder" type="LSString" value="BenchMod{i}"/>
+                            <attribute id="MD5" type="LSString" value="{rng.randbytes(16).hex()}"/>
+                            <attribute id="Name" type="LSString" value="Bench Mod {i}"/>
+                            <attribute id="UUID" type="FixedString" value="{random_uuid(rng)}"/>
+                            <attribute id="Version64" type="int64" value="{rng.randrange(1 << 55)}"/>
+                        </node>""")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"""<?xml version="1.0" encoding="UTF-8"?>
+<save>
+    <version major="4" minor="7" revision="1" build="3"/>
+    <region id="ModuleSettings">
+        <node id="root">
+            <children>
+                <node id="Mods">
+                    <children>
+{chr(10).join(mods)}
+                    </children>
+                </node>
+            </children>
+        </node>
+    </region>
+</save>
+""")
+
+def random_uuid(rng : random.Random) -> str:
+    h = rng.randbytes(16).hex()
+    return f"{h[:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:]}"
+
+def synthetic_mods(num_mods : int, seed : int = 1) -> List[mod.ModInfo]:
+    rng = random.Random(seed)
+    return [mod.ModInfo.from_record([
+                ["Folder", "LSString", f"NewMod{i}"],
+                ["MD5", "LSString", ""],
+                ["Name", "LSString", f"New Mod {i}"],
+                ["UUID", "FixedString", random_uuid(rng)],
+                ["Version64", "int64", "36028797018963968"],
+            ]) for i in range(num_mods)]
+
+
+def measure(fn, repeat : int):
+    """Runs fn repeat times and returns (best time in seconds, peak traced memory in bytes of one extra traced run, result of fn)"""
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return best, peak, result
+
+def bench_startup(repeat : int):
+    """Time to start the interpreter and import pak and mod"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "import pak, mod"], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"name" : "startup", "seconds" : best}
+
+def bench_pak(directory : str, version : int, count : int, size : int, mix : dict[str, int], repeat : int):
+    path = os.path.join(directory, f"bench_v{version}_{count}.pak")
+    write_pak(path, synthetic_files(count, size, mix), version=version)
+    results = []
+    with open(path, 'rb') as f:
+        seconds, peak, reader = measure(lambda: pak.PackageReader(f), repeat)
+        results.append({"name" : f"open/v{version}/{count}", "seconds" : seconds, "peak_bytes" : peak, "entries_per_s" : count / seconds})
+
+        def decode_names():
+            # names() caches its result
+            reader.table._names = None
+            return reader.table.names()
+        seconds, peak, _ = measure(decode_names, repeat)
+        results.append({"name" : f"names/v{version}/{count}", "seconds" : seconds, "peak_bytes" : peak, "entries_per_s" : count / seconds})
+
+        for method_name, method in METHODS.items():
+            files = [file for file in reader.files if file.info.get_compression_method() == method]
+            if not files:
+                continue
+            total = sum(file.info.uncompressed_size for file in files)
+
+            def read_all():
+                for file in files:
+                    file.read()
+            seconds, peak, _ = measure(read_all, repeat)
+            results.append({"name" : f"read/{method_name}/v{version}/{count}", "seconds" : seconds, "peak_bytes" : peak,
+                            "entries_per_s" : len(files) / seconds, "mb_per_s" : total / seconds / 1e6})
+        reader.close()
+    os.remove(path)
+    return results
+
+def bench_modsettings(directory : str, num_mods : int, repeat : int):
+    path = os.path.join(directory, f"bench_modsettings_{num_mods}.lsx")
+    write_modsettings(path, num_mods)
+    new_mods = synthetic_mods(num_mods)
+    results = []
+
+    def load():
+        with open(path, 'rb') as f:
+            return mod.ModSettingsLsx(f)
+    seconds, peak, _ = measure(load, repeat)
+    results.append({"name" : f"modsettings/load/{num_mods}", "seconds" : seconds, "peak_bytes" : peak, "entries_per_s" : num_mods / seconds})
+
+    def modify():
+        with open(path, 'rb') as f:
+            settings = mod.ModSettingsLsx(f)
+        start = time.perf_counter()
+        settings.remove_all_mods()
+        for m in new_mods:
+            settings.add_mod(m)
+        return time.perf_counter() - start
+    _, peak, _ = measure(modify, 1)
+    seconds = min(modify() for _ in range(repeat))
+    results.append({"name" : f"modsettings/modify/{num_mods}", "seconds" : seconds, "peak_bytes" : peak, "entries_per_s" : num_mods / seconds})
+
+    def save():
+        with open(path, 'rb') as f:
+            data = f.read()
+        with open(path, 'rb+') as f:
+            settings = mod.ModSettingsLsx(f)
+            start = time.perf_counter()
+            settings.save_file(force=True)
+            elapsed = time.perf_counter() - start
+        with open(path, 'wb') as f:
+            f.write(data)
+        return elapsed
+    seconds = min(save() for _ in range(repeat))
+    results.append({"name" : f"modsettings/save/{num_mods}", "seconds" : seconds, "entries_per_s" : num_mods / seconds})
+    os.remove(path)
+    return results
+
+def compare(results : List[dict], baseline : List[dict]):
+    """Prints the change of every result against the baseline run with the same name"""
+    old = {r["name"] : r for r in baseline}
+    print(f"{'benchmark':40} {'before':>10} {'after':>10} {'change':>8}")
+    for r in results:
+        b = old.get(r["name"])
+        if b is None:
+            continue
+        change = (r["seconds"] - b["seconds"]) / b["seconds"] * 100
+        print(f"{r['name']:40} {b['seconds']*1000:9.2f}ms {r['seconds']*1000:9.2f}ms {change:+7.1f}%")
+
+def format_result(r : dict) -> str:
+    parts = [f"{r['name']:40} {r['seconds']*1000:10.2f}ms"]
+    if "entries_per_s" in r:
+        parts.append(f"{r['entries_per_s']:12.0f} entries/s")
+    if "mb_per_s" in r:
+        parts.append(f"{r['mb_per_s']:9.1f} MB/s")
+    if "peak_bytes" in r:
+        parts.append(f"peak {r['peak_bytes']/1e6:8.1f} MB")
+    return " ".join(parts)
+
+def parse_mix(string : str) -> dict[str, int]:
+    mix = {}
+    for part in string.split(","):
+        name, _, weight = part.partition("=")
+        if name not in METHODS:
+            raise ValueError(f"unknown compression method {name}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark pak.py and mod.py on synthetic data')
+    parser.add_argument('--entries', default="10,1000,100000", help="comma separated entry counts of the generated paks")
+    parser.add_argument('--entry-size', type=int, default=4096, help="average uncompressed size of generated entries in bytes")
+    parser.add_argument('--mix', default="none=1,zlib=1,lz4=2", help="relative weights of compression methods, e.g. none=1,lz4=3")
+    parser.add_argument('--versions', default="15,16,18", help="comma separated package versions to generate")
+    parser.add_argument('--mods', default="1000,5000", help="comma separated ModuleShortDesc counts of the generated modsettings.lsx files")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark, the best one is reported")
+    parser.add_argument('--output', help="write the results to this json file")
+    parser.add_argument('--compare', help="json results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    mix = parse_mix(args.mix)
+    results = [bench_startup(args.repeat)]
+    print(format_result(results[0]))
+    with tempfile.TemporaryDirectory() as directory:
+        for version in [int(v) for v in args.versions.split(",")]:
+            for count in [int(c) for c in args.entries.split(",")]:
+                for r in bench_pak(directory, version, count, args.entry_size, mix, args.repeat):
+                    print(format_result(r))
+                    results.append(r)
+        for num_mods in [int(m) for m in args.mods.split(",") if m]:
+            for r in bench_modsettings(directory, num_mods, args.repeat):
+                print(format_result(r))
+                results.append(r)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({
+                    "time" : time.time(),
+                    "python" : platform.python_version(),
+                    "platform" : platform.platform(),
+                    "args" : vars(args),
+                    "results" : results,
+                }, f, indent=4)
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            compare(results, json.load(f)["results"])
@@ -0,0 +1,100 @@
+"""
+Opt-in counters and timers for the hot paths of pak.py and mod.py.
+
+Instrumented code looks up the module level `current` and skips all bookkeeping if it is None, so disabled instrumentation costs one
+global lookup per call. Enable it with enable(), run the code in question and print current.report():
+
+    stats = instrumentation.enable()
+    ...
+    print(stats.report())
+
+Code that only times a single call can use timed(), which does the same check:
+
+    data = instrumentation.timed("pak.decompress.zlib", decompress, compressed, count="pak.bytes_decompressed.zlib")
+
+Stages are named "<module>.<stage>", e.g. "pak.read", "pak.decompress.lz4" or "mod.parse.meta".
+"""
+
+import collections
+import threading
+import time
+
+class Stats:
+    """Thread safe collection of named counters and timers"""
+    def __init__(self):
+        self.counters : dict[str, int] = collections.defaultdict(int)
+        self.times : dict[str, float] = collections.defaultdict(float)
+        self.calls : dict[str, int] = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.start : float = time.perf_counter()
+
+    def count(self, name : str, amount : int = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def add_time(self, name : str, seconds : float):
+        with self.lock:
+            self.times[name] += seconds
+            self.calls[name] += 1
+
+    def timer(self, name : str):
+        """Context manager adding the time spent inside it to the timer name"""
+        return Timer(self, name)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                    "wall_seconds" : time.perf_counter() - self.start,
+                    "counters" : dict(self.counters),
+                    "timers" : {name : {"seconds" : self.times[name], "calls" : self.calls[name]} for name in self.times},
+                }
+
+    def report(self) -> str:
+        data = self.as_dict()
+        lines = [f"wall time {data['wall_seconds']*1000:.1f}ms"]
+        for name, timer in sorted(data["timers"].items()):
+            lines.append(f"  {name:32} {timer['seconds']*1000:10.1f}ms {timer['calls']:10} calls")
+        for name, value in sorted(data["counters"].items()):
+            lines.append(f"  {name:32} {value:12}")
+        return "\n".join(lines)
+
+
+class Timer:
+    __slots__ = ("stats", "name", "start")
+
+    def __init__(self, stats : Stats, name : str):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.add_time(self.name, time.perf_counter() - self.start)
+
+
+current : Stats | None = None
+
+def enable(stats : Stats | None = None) -> Stats:
+    """Starts collecting into stats(a fresh Stats object by default) and returns it"""
+    global current
+    current = stats or Stats()
+    return current
+
+def timed(name : str, fn, *args, count : str | None = None):
+    """Returns fn(*args), adding the time spent to the timer name and len() of the result to the counter count if instrumentation is enabled"""
+    stats = current
+    if stats is None:
+        return fn(*args)
+    with stats.timer(name):
+        result = fn(*args)
+    if count is not None:
+        stats.count(count, len(result))
+    return result
+
+def disable() -> Stats | None:
+    """Stops collecting and returns the stats collected so far"""
+    global current
+    stats, current = current, None
+    return stats
@@ -0,0 +1,164 @@
+"""
+Load order resolution based on the Dependencies declared in the meta.lsx of each mod.
+
+resolve() builds the dependency graph from the UUIDs of the ModInfo objects(see mod.ModMetaLsx and mod.ScanResult.mods) and sorts it topologically.
+Mods without a dependency relation keep the order they were given in, so an already working load order is not shuffled around.
+"""
+
+import heapq
+from typing import List, TYPE_CHECKING
+if TYPE_CHECKING:
+    # only for annotations, importing mod here would load a second copy of it when mod.py is run as a script
+    from mod import ModInfo
+
+# GustavDev, the base game module. It always stays active.
+BASE_MODULE_UUID = "28ac9ce2-2aba-8cda-b3b5-6e922f71b6b8"
+
+# modules shipped with the game, mods may depend on them without them being in the mod list
+BUILTIN_MODULE_UUIDS = {
+        BASE_MODULE_UUID, # GustavDev
+        "991c9c7a-fb80-40cb-8f0d-b92d4e80e9b1", # Gustav
+        "ed539163-bb70-431b-96a7-f5b2eda5376b", # Shared
+        "3d0c5ff8-c95d-c907-ff3e-34b204f1c630", # SharedDev
+    }
+
+class LoadOrder:
+    """
+    Result of resolve().
+
+    order - the mods in load order, every UUID once. Mods involved in cycles are appended in input order.
+    cycles - lists of UUIDs that depend on each other
+    missing - UUID of a mod -> UUIDs of its dependencies that are neither in the mod list nor built into the game
+    duplicates - UUID -> all mods given with that UUID. order contains the one with the highest version(the first of those on ties).
+    """
+    def __init__(self):
+        self.order : List["ModInfo"] = []
+        self.cycles : List[List[str]] = []
+        self.missing : dict[str, List[str]] = {}
+        self.duplicates : dict[str, List["ModInfo"]] = {}
+
+    def ok(self) -> bool:
+        return not (self.cycles or self.missing or self.duplicates)
+
+    def problems(self) -> List[str]:
+        """Human readable description of every problem found"""
+        names = {mod.uuid : mod.name() or mod.uuid for mod in self.order}
+        messages = []
+        for uuid, mods in self.duplicates.items():
+            versions = ", ".join(str(mod.version()) for mod in mods)
+            messages.append(f"{names[uuid]} was given {len(mods)} times(versions {versions}), using version {self.order_version(uuid)}")
+        for uuid, dependencies in self.missing.items():
+            messages.append(f"{names[uuid]} depends on missing mods: {', '.join(dependencies)}")
+        for cycle in self.cycles:
+            messages.append(f"dependency cycle between {', '.join(names[uuid] for uuid in cycle)}")
+        return messages
+
+    def order_version(self, uuid : str) -> int:
+        for mod in self.order:
+            if mod.uuid == uuid:
+                return mod.version()
+        return 0
+
+def resolve(mods : List["ModInfo"], available = ()) -> LoadOrder:
+    """
+    Sorts mods so that every mod comes after its dependencies.
+
+    available: UUIDs of mods that are not in mods but can be depended on, e.g. mods that are already active
+
+    The graph is built from the UUID and dependencies of each ModInfo, the sort is Kahn's algorithm picking the earliest given mod whenever
+    several are ready, so it runs in O((mods + dependencies) * log(mods)).
+    """
+    result = LoadOrder()
+
+    # one mod per UUID, at the position it was first given
+    unique : List["ModInfo"] = []
+    index : dict[str, int] = {}
+    for mod in mods:
+        i = index.get(mod.uuid)
+        if i is None:
+            index[mod.uuid] = len(unique)
+            unique.append(mod)
+            continue
+        result.duplicates.setdefault(mod.uuid, [unique[i]]).append(mod)
+        if mod.version() > unique[i].version():
+            unique[i] = mod
+
+    dependents : List[List[int]] = [[] for _ in unique]
+    in_degree : List[int] = [0] * len(unique)
+    for i, mod in enumerate(unique):
+        missing = []
+        for dependency in dict.fromkeys(mod.dependencies):
+            j = index.get(dependency)
+            if j is None:
+                if dependency not in BUILTIN_MODULE_UUIDS and dependency not in available:
+                    missing.append(dependency)
+            elif j != i:
+                dependents[j].append(i)
+                in_degree[i] += 1
+        if missing:
+            result.missing[mod.uuid] = missing
+
+    ready = [i for i in range(len(unique)) if in_degree[i] == 0]
+    heapq.heapify(ready)
+    while ready:
+        i = heapq.heappop(ready)
+        result.order.append(unique[i])
+        for j in dependents[i]:
+            in_degree[j] -= 1
+            if in_degree[j] == 0:
+                heapq.heappush(ready, j)
+
+    if len(result.order) < len(unique):
+        remaining = [i for i in range(len(unique)) if in_degree[i] > 0]
+        result.cycles = [[unique[i].uuid for i in component] for component in cycles(remaining, dependents)]
+        result.order.extend(unique[i] for i in remaining)
+    return result
+
+def cycles(nodes : List[int], edges : List[List[int]]) -> List[List[int]]:
+    """Strongly connected components with more than one node among nodes(Tarjan's algorithm, iterative), each sorted"""
+    members = set(nodes)
+    number : dict[int, int] = {}
+    low : dict[int, int] = {}
+    stack : List[int] = []
+    on_stack = set()
+    components = []
+    for root in nodes:
+        if root in number:
+            continue
+        work = [(root, 0)]
+        while work:
+            node, edge = work.pop()
+            if edge == 0:
+                number[node] = low[node] = len(number)
+                stack.append(node)
+                on_stack.add(node)
+            recurse = False
+            successors = edges[node]
+            while edge < len(successors):
+                successor = successors[edge]
+                edge += 1
+                if successor not in members:
+                    continue
+                if successor not in number:
+                    work.append((node, edge))
+                    work.append((successor, 0))
+                    recurse = True
+                    break
+                if successor in on_stack:
+                    low[node] = min(low[node], number[successor])
+            if recurse:
+                continue
+            if low[node] == number[node]:
+                component = []
+                while True:
+                    member = stack.pop()
+                    on_stack.discard(member)
+                    component.append(member)
+                    if member == node:
+                        break
+                if len(component) > 1:
+                    components.append(sorted(component))
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+    return components
@@ -0,0 +1,506 @@
+"""
+This file provides a reader for Larian Studios' binary .lsf resources, the compact form of .lsx files. Loosely based on https://github.com/Norbyte/lslib
+
+The name table, node and attribute arrays are decoded in bulk when the resource is opened, attribute values are only decoded when they are accessed.
+"""
+
+import base64
+import enum
+import struct
+import uuid
+import zlib
+import lz4.block
+import lz4.frame
+from ctypes import *
+from typing import List
+from lxml import etree
+import lsx_attribute
+
+LSF_MAGIC = b"LSOF"
+LZ4_FRAME_MAGIC = b"\x04\x22\x4d\x18"
+
+class LSFVersion(enum.IntEnum):
+    INITIAL = 1
+    CHUNKED_COMPRESS = 2
+    EXTENDED_NODES = 3
+    BG3 = 4
+    BG3_EXTENDED_HEADER = 5
+    BG3_NODE_KEYS = 6
+    BG3_PATCH3 = 7
+
+class LSFMagic(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("magic", c_char*4),
+            ("version", c_uint32)
+        ]
+class LSFHeader(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("engine_version", c_uint32)
+        ]
+class LSFHeaderV5(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("engine_version", c_uint64)
+        ]
+class LSFMetadataV5(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("strings_uncompressed_size", c_uint32),
+            ("strings_size_on_disk", c_uint32),
+            ("nodes_uncompressed_size", c_uint32),
+            ("nodes_size_on_disk", c_uint32),
+            ("attributes_uncompressed_size", c_uint32),
+            ("attributes_size_on_disk", c_uint32),
+            ("values_uncompressed_size", c_uint32),
+            ("values_size_on_disk", c_uint32),
+            ("compression_flags", c_uint8),
+            ("unknown2", c_uint8),
+            ("unknown3", c_uint16),
+            ("metadata_format", c_uint32)
+        ]
+class LSFMetadataV6(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("strings_uncompressed_size", c_uint32),
+            ("strings_size_on_disk", c_uint32),
+            ("keys_uncompressed_size", c_uint32),
+            ("keys_size_on_disk", c_uint32),
+            ("nodes_uncompressed_size", c_uint32),
+            ("nodes_size_on_disk", c_uint32),
+            ("attributes_uncompressed_size", c_uint32),
+            ("attributes_size_on_disk", c_uint32),
+            ("values_uncompressed_size", c_uint32),
+            ("values_size_on_disk", c_uint32),
+            ("compression_flags", c_uint8),
+            ("unknown2", c_uint8),
+            ("unknown3", c_uint16),
+            ("metadata_format", c_uint32)
+        ]
+class LSFNodeEntryV2(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("name_hash_table_index", c_uint32),
+            ("first_attribute_index", c_int32),
+            ("parent_index", c_int32)
+        ]
+class LSFNodeEntryV3(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("name_hash_table_index", c_uint32),
+            ("parent_index", c_int32),
+            ("next_sibling_index", c_int32),
+            ("first_attribute_index", c_int32)
+        ]
+class LSFAttributeEntryV2(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("name_hash_table_index", c_uint32),
+            ("type_and_length", c_uint32),
+            ("node_index", c_int32)
+        ]
+class LSFAttributeEntryV3(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("name_hash_table_index", c_uint32),
+            ("type_and_length", c_uint32),
+            ("next_attribute_index", c_int32),
+            ("offset", c_uint32)
+        ]
+class LSFKeyEntry(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("node_index", c_uint32),
+            ("key_name", c_uint32)
+        ]
+
+# metadata_format value of files with node keys and sibling/attribute links(V3 node and attribute entries)
+METADATA_FORMAT_KEYS_AND_ADJACENCY = 1
+
+# LSF attribute type id -> (LSX type name, struct format of the value or None for variable size types)
+ATTRIBUTE_TYPES = {
+        0 : ("None", None),
+        1 : ("uint8", "<B"),
+        2 : ("int16", "<h"),
+        3 : ("uint16", "<H"),
+        4 : ("int32", "<i"),
+        5 : ("uint32", "<I"),
+        6 : ("float", "<f"),
+        7 : ("double", "<d"),
+        8 : ("ivec2", "<2i"),
+        9 : ("ivec3", "<3i"),
+        10 : ("ivec4", "<4i"),
+        11 : ("fvec2", "<2f"),
+        12 : ("fvec3", "<3f"),
+        13 : ("fvec4", "<4f"),
+        14 : ("mat2x2", "<4f"),
+        15 : ("mat3x3", "<9f"),
+        16 : ("mat3x4", "<12f"),
+        17 : ("mat4x3", "<12f"),
+        18 : ("mat4x4", "<16f"),
+        19 : ("bool", "<?"),
+        20 : ("string", None),
+        21 : ("path", None),
+        22 : ("FixedString", None),
+        23 : ("LSString", None),
+        24 : ("uint64", "<Q"),
+        25 : ("ScratchBuffer", None),
+        26 : ("old_int64", "<q"),
+        27 : ("int8", "<b"),
+        28 : ("TranslatedString", None),
+        29 : ("WString", None),
+        30 : ("LSWString", None),
+        31 : ("guid", None),
+        32 : ("int64", "<q"),
+        33 : ("TranslatedFSString", None),
+    }
+STRING_TYPES = {20, 21, 22, 23, 29, 30}
+
+def format_guid(data : bytes) -> str:
+    """LSF stores GUIDs in .NET byte order, with the bytes of the last 8 swapped pairwise"""
+    swapped = bytearray(data)
+    swapped[8:16:2], swapped[9:16:2] = data[9:16:2], data[8:16:2]
+    return str(uuid.UUID(bytes_le=bytes(swapped)))
+
+def decompress(data, uncompressed_size : int, compression_flags : int) -> bytes:
+    method = compression_flags & 0x0F
+    match method:
+        case 0:
+            return bytes(data)
+        case 1:
+            return zlib.decompress(data)
+        case 2:
+            if bytes(data[:4]) == LZ4_FRAME_MAGIC:
+                return lz4.frame.decompress(data)
+            return lz4.block.decompress(data, uncompressed_size = uncompressed_size)
+        case _:
+            raise Exception(f"Unsupported LSF compression method({method})")
+
+
+class TranslatedFSString:
+    """Translated string with arguments, which are themselves translated strings"""
+    def __init__(self, value : str | None, handle : str, version : int, arguments : list):
+        self.value = value
+        self.handle = handle
+        self.version = version
+        # (key, TranslatedFSString, value) tuples
+        self.arguments = arguments
+
+
+class ValueReader:
+    """Cursor over the values section, for the variable sized types"""
+    def __init__(self, data : bytes, offset : int, bg3_strings : bool):
+        self.data = data
+        self.offset = offset
+        self.bg3_strings = bg3_strings
+
+    def read(self, fmt : str):
+        value = struct.unpack_from(fmt, self.data, self.offset)
+        self.offset += struct.calcsize(fmt)
+        return value[0]
+
+    def read_string(self, length : int) -> str:
+        data = self.data[self.offset:self.offset+length]
+        self.offset += length
+        return data.partition(b"\0")[0].decode()
+
+    def read_translated_string(self):
+        """Returns (value, handle, version). Since BG3 only the version is stored instead of the value."""
+        if self.bg3_strings:
+            value = None
+            version = self.read("<H")
+        else:
+            version = 0
+            value = self.read_string(self.read("<i"))
+        handle = self.read_string(self.read("<i"))
+        return value, handle, version
+
+    def read_translated_fs_string(self) -> TranslatedFSString:
+        value, handle, version = self.read_translated_string()
+        arguments = []
+        for _ in range(self.read("<i")):
+            key = self.read_string(self.read("<i"))
+            string = self.read_translated_fs_string()
+            argument_value = self.read_string(self.read("<i"))
+            arguments.append((key, string, argument_value))
+        return TranslatedFSString(value, handle, version, arguments)
+
+
+class LsfNode:
+    """Lazy view of a node of an LsfResource"""
+    def __init__(self, resource : "LsfResource", index : int):
+        self.resource = resource
+        self.index = index
+
+    def name(self) -> str:
+        return self.resource.node_name(self.index)
+
+    def key(self) -> str | None:
+        return self.resource.keys.get(self.index)
+
+    def parent(self) -> "LsfNode | None":
+        parent_index = self.resource.nodes[self.index].parent_index
+        return None if parent_index < 0 else LsfNode(self.resource, parent_index)
+
+    def children(self) -> List["LsfNode"]:
+        return [LsfNode(self.resource, i) for i in self.resource.children[self.index]]
+
+    def attribute_indices(self) -> List[int]:
+        return self.resource.node_attributes[self.index]
+
+    def attributes(self) -> dict[str, lsx_attribute.LsxAttribute]:
+        """The attributes of the node as LsxAttributes, like those parsed from .lsx files"""
+        result = {}
+        for i in self.attribute_indices():
+            attr = lsx_attribute.LsxAttribute.from_etree_element(self.resource.attribute_element(i))
+            result[attr.id] = attr
+        return result
+
+    def find(self, name : str) -> "LsfNode | None":
+        """First child with the given name"""
+        for i in self.resource.children[self.index]:
+            if self.resource.node_name(i) == name:
+                return LsfNode(self.resource, i)
+        return None
+
+    def to_etree(self) -> etree.Element:
+        """The node as an lxml element with the same layout as in .lsx files"""
+        return self.resource.node_element(self.index)
+
+
+class LsfResource:
+    """
+    A parsed .lsf file.
+
+    nodes and attributes are ctypes arrays over the decompressed sections, names is the decoded name hash table. Use regions() or to_etree() to get at the contents.
+    """
+    def __init__(self, data):
+        data = bytes(data)
+        magic = LSFMagic.from_buffer_copy(data, 0)
+        if magic.magic != LSF_MAGIC:
+            raise Exception("Not an LSF file")
+        self.version : int = magic.version
+        if not LSFVersion.INITIAL <= self.version <= LSFVersion.BG3_PATCH3:
+            raise Exception(f"LSF version {self.version} not supported")
+        offset = sizeof(LSFMagic)
+
+        if self.version >= LSFVersion.BG3_EXTENDED_HEADER:
+            header = LSFHeaderV5.from_buffer_copy(data, offset)
+            offset += sizeof(LSFHeaderV5)
+            v = header.engine_version
+            self.engine_version = ((v >> 55) & 0x7f, (v >> 47) & 0xff, (v >> 31) & 0xffff, v & 0x7fffffff)
+        else:
+            header = LSFHeader.from_buffer_copy(data, offset)
+            offset += sizeof(LSFHeader)
+            v = header.engine_version
+            self.engine_version = ((v >> 28) & 0x0f, (v >> 24) & 0x0f, (v >> 16) & 0xff, v & 0xffff)
+
+        metadata_type = LSFMetadataV6 if self.version >= LSFVersion.BG3_NODE_KEYS else LSFMetadataV5
+        self.metadata = metadata_type.from_buffer_copy(data, offset)
+        offset += sizeof(metadata_type)
+        major, minor, revision, build = self.engine_version
+        # translated strings store a version instead of their value since BG3(and late DOS2 DE builds)
+        self.bg3_strings : bool = (self.version >= LSFVersion.BG3 or major > 4
+                                   or (major == 4 and revision > 0) or (major == 4 and revision == 0 and build >= 0x1a))
+
+        def section(size_on_disk : int, uncompressed_size : int):
+            nonlocal offset
+            if size_on_disk == 0:
+                # stored uncompressed(or empty)
+                result = data[offset:offset+uncompressed_size]
+                offset += uncompressed_size
+                return result
+            result = decompress(memoryview(data)[offset:offset+size_on_disk], uncompressed_size, self.metadata.compression_flags)
+            offset += size_on_disk
+            return result
+
+        meta = self.metadata
+        strings = section(meta.strings_size_on_disk, meta.strings_uncompressed_size)
+        nodes = section(meta.nodes_size_on_disk, meta.nodes_uncompressed_size)
+        attributes = section(meta.attributes_size_on_disk, meta.attributes_uncompressed_size)
+        self.values : bytes = section(meta.values_size_on_disk, meta.values_uncompressed_size)
+        keys = b""
+        if metadata_type is LSFMetadataV6 and meta.keys_uncompressed_size:
+            keys = section(meta.keys_size_on_disk, meta.keys_uncompressed_size)
+
+        self.names : List[List[str]] = self.read_names(strings)
+        long_entries = self.version >= LSFVersion.EXTENDED_NODES and meta.metadata_format == METADATA_FORMAT_KEYS_AND_ADJACENCY
+        node_type = LSFNodeEntryV3 if long_entries else LSFNodeEntryV2
+        attribute_type = LSFAttributeEntryV3 if long_entries else LSFAttributeEntryV2
+        self.nodes = (node_type * (len(nodes) // sizeof(node_type))).from_buffer_copy(nodes)
+        self.attributes = (attribute_type * (len(attributes) // sizeof(attribute_type))).from_buffer_copy(attributes)
+
+        # children and attribute lists of every node, built in one pass over each array
+        self.children : List[List[int]] = [[] for _ in range(len(self.nodes))]
+        self.root_nodes : List[int] = []
+        for i, node in enumerate(self.nodes):
+            if node.parent_index < 0:
+                self.root_nodes.append(i)
+            else:
+                self.children[node.parent_index].append(i)
+        self.node_attributes : List[List[int]] = [[] for _ in range(len(self.nodes))]
+        # offset of every attribute value in the values section
+        self.value_offsets : List[int] = [0] * len(self.attributes)
+        if long_entries:
+            for i, attr in enumerate(self.attributes):
+                self.value_offsets[i] = attr.offset
+            for node_index, node in enumerate(self.nodes):
+                attr_index = node.first_attribute_index
+                attrs = self.node_attributes[node_index]
+                while attr_index >= 0:
+                    attrs.append(attr_index)
+                    attr_index = self.attributes[attr_index].next_attribute_index
+        else:
+            value_offset = 0
+            for i, attr in enumerate(self.attributes):
+                self.value_offsets[i] = value_offset
+                value_offset += attr.type_and_length >> 6
+                self.node_attributes[attr.node_index].append(i)
+
+        self.keys : dict[int, str] = {}
+        if keys:
+            for key in (LSFKeyEntry * (len(keys) // sizeof(LSFKeyEntry))).from_buffer_copy(keys):
+                self.keys[key.node_index] = self.name(key.key_name)
+
+    def read_names(self, strings : bytes) -> List[List[str]]:
+        names = []
+        offset = 0
+        (num_hash_entries,) = struct.unpack_from("<I", strings, offset)
+        offset += 4
+        for _ in range(num_hash_entries):
+            (num_strings,) = struct.unpack_from("<H", strings, offset)
+            offset += 2
+            chain = []
+            for _ in range(num_strings):
+                (length,) = struct.unpack_from("<H", strings, offset)
+                offset += 2
+                chain.append(strings[offset:offset+length].decode())
+                offset += length
+            names.append(chain)
+        return names
+
+    def name(self, name_hash_table_index : int) -> str:
+        return self.names[name_hash_table_index >> 16][name_hash_table_index & 0xffff]
+
+    def node_name(self, index : int) -> str:
+        return self.name(self.nodes[index].name_hash_table_index)
+
+    def regions(self) -> dict[str, LsfNode]:
+        """The root nodes of the resource by name. In .lsx files each of these is a region containing the node of the same name."""
+        return {self.node_name(i) : LsfNode(self, i) for i in self.root_nodes}
+
+    def node(self, index : int) -> LsfNode:
+        return LsfNode(self, index)
+
+    def attribute_name(self, index : int) -> str:
+        return self.name(self.attributes[index].name_hash_table_index)
+
+    def attribute_type(self, index : int) -> str:
+        type_id = self.attributes[index].type_and_length & 0x3f
+        type_info = ATTRIBUTE_TYPES.get(type_id)
+        if type_info is None:
+            raise Exception(f"Unknown LSF attribute type {type_id}")
+        return type_info[0]
+
+    def attribute_value(self, index : int):
+        """The python value of an attribute: int, float, bool, str, tuple for vectors and matrices, bytes for ScratchBuffer,
+        (value, handle, version) for TranslatedString and TranslatedFSString for TranslatedFSString"""
+        attr = self.attributes[index]
+        type_id = attr.type_and_length & 0x3f
+        length = attr.type_and_length >> 6
+        offset = self.value_offsets[index]
+        type_name, fmt = ATTRIBUTE_TYPES[type_id]
+        if fmt is not None:
+            values = struct.unpack_from(fmt, self.values, offset)
+            return values[0] if len(values) == 1 else values
+        reader = ValueReader(self.values, offset, self.bg3_strings)
+        match type_id:
+            case _ if type_id in STRING_TYPES:
+                return reader.read_string(length)
+            case 25:
+                return self.values[offset:offset+length]
+            case 28:
+                return reader.read_translated_string()
+            case 31:
+                return format_guid(self.values[offset:offset+16])
+            case 33:
+                return reader.read_translated_fs_string()
+            case _:
+                return None
+
+    def attribute_element(self, index : int) -> etree.Element:
+        """The attribute as an lxml element, as it would appear in an .lsx file"""
+        type_name = self.attribute_type(index)
+        value = self.attribute_value(index)
+        element = etree.Element("attribute", id=self.attribute_name(index), type=type_name)
+        match value:
+            case TranslatedFSString():
+                self.set_fs_string_attributes(element, value)
+            case tuple() if type_name == "TranslatedString":
+                string_value, handle, version = value
+                if string_value is not None:
+                    element.set("value", string_value)
+                element.set("handle", handle)
+                if string_value is None:
+                    element.set("version", str(version))
+            case _:
+                element.set("value", self.format_value(type_name, value))
+        return element
+
+    def set_fs_string_attributes(self, element : etree.Element, string : TranslatedFSString):
+        if string.value is not None:
+            element.set("value", string.value)
+        else:
+            element.set("version", str(string.version))
+        element.set("handle", string.handle)
+        element.set("arguments", str(len(string.arguments)))
+        if string.arguments:
+            arguments = etree.SubElement(element, "arguments")
+            for key, argument_string, argument_value in string.arguments:
+                argument = etree.SubElement(arguments, "argument", key=key, value=argument_value)
+                self.set_fs_string_attributes(etree.SubElement(argument, "string"), argument_string)
+
+    def format_value(self, type_name : str, value) -> str:
+        match value:
+            case bool():
+                return "True" if value else "False"
+            case float():
+                return lsx_attribute.format_float(value, type_name != "double")
+            case tuple():
+                if type_name.startswith("fvec") or type_name.startswith("mat"):
+                    return " ".join(lsx_attribute.format_float(v, True) for v in value)
+                return " ".join(str(v) for v in value)
+            case bytes():
+                return base64.b64encode(value).decode()
+            case None:
+                return ""
+            case _:
+                return str(value)
+
+    def node_element(self, index : int) -> etree.Element:
+        element = etree.Element("node", id=self.node_name(index))
+        key = self.keys.get(index)
+        if key is not None:
+            element.set("key", key)
+        for attr_index in self.node_attributes[index]:
+            element.append(self.attribute_element(attr_index))
+        if self.children[index]:
+            children = etree.SubElement(element, "children")
+            for child in self.children[index]:
+                children.append(self.node_element(child))
+        return element
+
+    def to_etree(self) -> etree.Element:
+        """The whole resource as an lxml tree with the same layout as the equivalent .lsx file"""
+        save = etree.Element("save")
+        major, minor, revision, build = self.engine_version
+        etree.SubElement(save, "version", major=str(major), minor=str(minor), revision=str(revision), build=str(build))
+        for i in self.root_nodes:
+            region = etree.SubElement(save, "region", id=self.node_name(i))
+            region.append(self.node_element(i))
+        return save
+
+def read_lsf(data) -> LsfResource:
+    """Parses the contents of an .lsf file, e.g. the result of FileReader.read()"""
+    return LsfResource(data)
@@ -1,3 +1,5 @@
+import struct
+from copy import deepcopy
 from lxml import etree
 
 class DataType:
@@ -11,15 +13,32 @@ class DataType:
     tostring(self) - convert the object to a string (e.g. 32 to "32")
     fromstring(self) - try to initialize a new object from the string
     self.value - an object holding the python value of the type
+
+    Types whose value is not just the "value" attribute of the element(e.g. TranslatedString) override fromelement and element_attributes.
+    Values only hold a slot for the value, so subclasses have to declare __slots__ as well.
     """
+    __slots__ = ("value",)
+
     def __init__(self, value = None):
         self.value = value
         if self.value is not None:
             if not isinstance(self.value, self.PYTHON_TYPE):
-                raise TypeError(f"LSX DataType {NAME} initialized with incorrect type({type(self.value)})")
+                raise TypeError(f"LSX DataType {self.NAME} initialized with incorrect type({type(self.value)})")
     @classmethod
     def getname(cls):
         return cls.NAME
+
+    @classmethod
+    def fromelement(cls, e : etree.Element):
+        """Initializes a new object from an <attribute> element"""
+        return cls.fromstring(e.get('value'))
+
+    def element_attributes(self) -> dict[str, str]:
+        """The xml attributes of the <attribute> element holding this value, apart from id and type. A missing value is left out."""
+        return {"value": self.tostring()} if self.value is not None else {}
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.value!r})"
 #TODO: use python's abc library to have proper abstract classes
 
 class DataTypeInt(DataType):
@@ -32,6 +51,7 @@ class DataTypeInt(DataType):
     NUM_BITS : int - number of bits in the integer
     SIGNED : bool - whether the integer is signed
     """
+    __slots__ = ()
     PYTHON_TYPE = int
 
     @classmethod
@@ -40,14 +60,14 @@ class DataTypeInt(DataType):
         try:
             self.value = int(string)
         except:
-            raise ValueException(f"invalid argument for initialization of DT_Int{string}")
+            raise ValueError(f"invalid argument for initialization of {cls.__name__}({string})")
         if not cls.check_bounds(self.value):
-            raise ValueException(f"Value is too large for {cls.__name__}(value={self.value})")
+            raise ValueError(f"Value is too large for {cls.__name__}(value={self.value})")
         return self
 
     def tostring(self):
         if not self.check_bounds(self.value):
-            raise ValueException(f"Value is too large for {cls.__name__}(value={self.value})")
+            raise ValueError(f"Value is too large for {type(self).__name__}(value={self.value})")
         return str(self.value)
     @classmethod
     def check_bounds(cls, value):
@@ -60,39 +80,192 @@ class DataTypeInt(DataType):
         return min_value <= value <= max_value
 
 class DT_Int8(DataTypeInt):
+    __slots__ = ()
     NAME = "int8"
     NUM_BITS = 8
     SIGNED = True
 class DT_UInt8(DataTypeInt):
-    NAME = "int8"
+    __slots__ = ()
+    NAME = "uint8"
     NUM_BITS = 8
     SIGNED = False
 class DT_Int16(DataTypeInt):
+    __slots__ = ()
     NAME = "int16"
     NUM_BITS = 16
     SIGNED = True
 class DT_UInt16(DataTypeInt):
-    NAME = "int16"
+    __slots__ = ()
+    NAME = "uint16"
     NUM_BITS = 16
     SIGNED = False
 class DT_Int32(DataTypeInt):
+    __slots__ = ()
     NAME = "int32"
     NUM_BITS = 32
     SIGNED = True
 class DT_UInt32(DataTypeInt):
-    NAME = "int32"
+    __slots__ = ()
+    NAME = "uint32"
     NUM_BITS = 32
     SIGNED = False
 class DT_Int64(DataTypeInt):
+    __slots__ = ()
     NAME = "int64"
     NUM_BITS = 64
     SIGNED = True
 class DT_UInt64(DataTypeInt):
-    NAME = "int64"
+    __slots__ = ()
+    NAME = "uint64"
     NUM_BITS = 64
     SIGNED = False
+class DT_OldInt64(DataTypeInt): # "Long" in LSLib, only used by old games
+    __slots__ = ()
+    NAME = "old_int64"
+    NUM_BITS = 64
+    SIGNED = True
+
+class DT_Bool(DataType):
+    __slots__ = ()
+    NAME = "bool"
+    PYTHON_TYPE = bool
+
+    @classmethod
+    def fromstring(cls, string):
+        if string is None:
+            raise ValueError(f"{cls.__name__} needs a value")
+        match string.lower():
+            case "true" | "1":
+                return cls(True)
+            case "false" | "0":
+                return cls(False)
+            case _:
+                raise ValueError(f"invalid argument for initialization of {cls.__name__}({string})")
+    def tostring(self):
+        return "True" if self.value else "False"
+
+def format_float(value : float, single : bool) -> str:
+    """Shortest string that reads back as the same float(or float32, if single is set), like .NET writes them into LSX files"""
+    if single:
+        packed = struct.pack("<f", value)
+        for precision in range(1, 10):
+            s = f"{value:.{precision}g}"
+            if struct.pack("<f", float(s)) == packed:
+                break
+    else:
+        s = repr(value)
+    if s.endswith(".0"):
+        s = s[:-2]
+    return s
+
+class DT_Float(DataType):
+    __slots__ = ()
+    NAME = "float"
+    PYTHON_TYPE = float
+    SINGLE = True
+
+    @classmethod
+    def fromstring(cls, string):
+        if string is None:
+            raise ValueError(f"{cls.__name__} needs a value")
+        try:
+            return cls(float(string))
+        except:
+            raise ValueError(f"invalid argument for initialization of {cls.__name__}({string})")
+    def tostring(self):
+        return format_float(self.value, self.SINGLE)
+class DT_Double(DT_Float):
+    __slots__ = ()
+    NAME = "double"
+    SINGLE = False
+
+class DataTypeVector(DataType):
+    """
+    Base class for vector and matrix types, written as space separated components.
+
+    All inheriting classes must have the following memebers:
+
+    NAME : str - name of the type
+    COMPONENT_TYPE : type - int or float
+    NUM_COMPONENTS : int - number of components(rows*columns for matrices)
+    """
+    __slots__ = ()
+    PYTHON_TYPE = tuple
+
+    @classmethod
+    def fromstring(cls, string):
+        if string is None:
+            raise ValueError(f"{cls.__name__} needs a value")
+        try:
+            value = tuple(cls.COMPONENT_TYPE(c) for c in string.split())
+        except:
+            raise ValueError(f"invalid argument for initialization of {cls.__name__}({string})")
+        if len(value) != cls.NUM_COMPONENTS:
+            raise ValueError(f"{cls.__name__} needs {cls.NUM_COMPONENTS} components, got {len(value)}")
+        return cls(value)
+    def tostring(self):
+        if self.COMPONENT_TYPE is float:
+            return " ".join(format_float(c, True) for c in self.value)
+        return " ".join(str(c) for c in self.value)
+
+class DT_IVec2(DataTypeVector):
+    __slots__ = ()
+    NAME = "ivec2"
+    COMPONENT_TYPE = int
+    NUM_COMPONENTS = 2
+class DT_IVec3(DataTypeVector):
+    __slots__ = ()
+    NAME = "ivec3"
+    COMPONENT_TYPE = int
+    NUM_COMPONENTS = 3
+class DT_IVec4(DataTypeVector):
+    __slots__ = ()
+    NAME = "ivec4"
+    COMPONENT_TYPE = int
+    NUM_COMPONENTS = 4
+class DT_FVec2(DataTypeVector):
+    __slots__ = ()
+    NAME = "fvec2"
+    COMPONENT_TYPE = float
+    NUM_COMPONENTS = 2
+class DT_FVec3(DataTypeVector):
+    __slots__ = ()
+    NAME = "fvec3"
+    COMPONENT_TYPE = float
+    NUM_COMPONENTS = 3
+class DT_FVec4(DataTypeVector):
+    __slots__ = ()
+    NAME = "fvec4"
+    COMPONENT_TYPE = float
+    NUM_COMPONENTS = 4
+class DT_Mat2x2(DataTypeVector):
+    __slots__ = ()
+    NAME = "mat2x2"
+    COMPONENT_TYPE = float
+    NUM_COMPONENTS = 4
+class DT_Mat3x3(DataTypeVector):
+    __slots__ = ()
+    NAME = "mat3x3"
+    COMPONENT_TYPE = float
+    NUM_COMPONENTS = 9
+class DT_Mat3x4(DataTypeVector):
+    __slots__ = ()
+    NAME = "mat3x4"
+    COMPONENT_TYPE = float
+    NUM_COMPONENTS = 12
+class DT_Mat4x3(DataTypeVector):
+    __slots__ = ()
+    NAME = "mat4x3"
+    COMPONENT_TYPE = float
+    NUM_COMPONENTS = 12
+class DT_Mat4x4(DataTypeVector):
+    __slots__ = ()
+    NAME = "mat4x4"
+    COMPONENT_TYPE = float
+    NUM_COMPONENTS = 16
 
 class DT_LSString(DataType):
+    __slots__ = ()
     NAME = "LSString"
     PYTHON_TYPE = str
 
@@ -104,18 +277,94 @@ class DT_LSString(DataType):
         return self.value
 
 class DT_FixedString(DT_LSString): # I don't understand the difference between this and LSString, so I just treat them the same for now
+    __slots__ = ()
     NAME = "FixedString"
+class DT_String(DT_LSString):
+    __slots__ = ()
+    NAME = "string"
+class DT_Path(DT_LSString):
+    __slots__ = ()
+    NAME = "path"
+class DT_WString(DT_LSString):
+    __slots__ = ()
+    NAME = "WString"
+class DT_LSWString(DT_LSString):
+    __slots__ = ()
+    NAME = "LSWString"
+class DT_Guid(DT_LSString):
+    __slots__ = ()
+    NAME = "guid"
+class DT_ScratchBuffer(DT_LSString): # base64 encoded, kept as the encoded string
+    __slots__ = ()
+    NAME = "ScratchBuffer"
+
+class DT_TranslatedString(DataType):
+    """
+    Reference to a localized string. value is the handle, BG3 stores a version next to it while older games store the untranslated text.
+    """
+    __slots__ = ("version", "text")
+    NAME = "TranslatedString"
+    PYTHON_TYPE = str
+
+    def __init__(self, value = None, version : int | None = None, text : str | None = None):
+        super().__init__(value)
+        self.version = version
+        self.text = text
+
+    @classmethod
+    def fromstring(cls, string):
+        return cls(string)
+    @classmethod
+    def fromelement(cls, e : etree.Element):
+        version = e.get('version')
+        return cls(e.get('handle'), int(version) if version is not None else None, e.get('value'))
+    def tostring(self):
+        return self.value
+    def element_attributes(self) -> dict[str, str]:
+        attributes = {}
+        if self.text is not None:
+            attributes["value"] = self.text
+        attributes["handle"] = self.value or ""
+        if self.version is not None:
+            attributes["version"] = str(self.version)
+        return attributes
+
+class DT_TranslatedFSString(DT_TranslatedString):
+    """TranslatedString with arguments. The <arguments> child element is kept as is."""
+    __slots__ = ("arguments",)
+    NAME = "TranslatedFSString"
+
+    def __init__(self, value = None, version : int | None = None, text : str | None = None, arguments : etree.Element = None):
+        super().__init__(value, version, text)
+        self.arguments = arguments
+
+    @classmethod
+    def fromelement(cls, e : etree.Element):
+        self = super().fromelement(e)
+        self.arguments = e.find('arguments')
+        return self
+    def element_attributes(self) -> dict[str, str]:
+        attributes = super().element_attributes()
+        attributes["arguments"] = str(len(self.arguments) if self.arguments is not None else 0)
+        return attributes
+
+UNKNOWN_DATA_TYPES = {}
 
 def Unknown_DataType(name : str):
-    class DT_Unknown(DataType):
-        NAME = name
-        PYTHON_TYPE = str
-        def fromstring(string):
-            self = DT_Unknown(string)
-            return self
-        def tostring(self):
-            return self.value
-    return DT_Unknown
+    """String valued type for type names this module does not know. The class is created once per name."""
+    data_type = UNKNOWN_DATA_TYPES.get(name)
+    if data_type is None:
+        class DT_Unknown(DataType):
+            __slots__ = ()
+            NAME = name
+            PYTHON_TYPE = str
+            @classmethod
+            def fromstring(cls, string):
+                return cls(string)
+            def tostring(self):
+                return self.value
+        data_type = UNKNOWN_DATA_TYPES.setdefault(name, DT_Unknown)
+    return data_type
 
 DATA_TYPE_LOOKUP_TABLE = {
         cls.NAME : cls for cls in [
@@ -127,15 +376,47 @@ DATA_TYPE_LOOKUP_TABLE = {
             DT_UInt32,
             DT_Int64,
             DT_UInt64,
+            DT_OldInt64,
+            DT_Bool,
+            DT_Float,
+            DT_Double,
+            DT_IVec2,
+            DT_IVec3,
+            DT_IVec4,
+            DT_FVec2,
+            DT_FVec3,
+            DT_FVec4,
+            DT_Mat2x2,
+            DT_Mat3x3,
+            DT_Mat3x4,
+            DT_Mat4x3,
+            DT_Mat4x4,
             DT_LSString,
-            DT_FixedString
+            DT_FixedString,
+            DT_String,
+            DT_Path,
+            DT_WString,
+            DT_LSWString,
+            DT_Guid,
+            DT_ScratchBuffer,
+            DT_TranslatedString,
+            DT_TranslatedFSString
         ]
     }
 
 def lookup_type(type_name):
     return DATA_TYPE_LOOKUP_TABLE.get(type_name) or Unknown_DataType(type_name)
 
+def parse_value(e : etree.Element, data_type) -> DataType:
+    """Parses the value of an <attribute> element. Values that are not valid for their type are kept as strings(see Unknown_DataType)."""
+    try:
+        return data_type.fromelement(e)
+    except (ValueError, TypeError):
+        return Unknown_DataType(e.get('type')).fromelement(e)
+
 class LsxAttribute:
+    __slots__ = ("id", "value", "element")
+
     def __init__(self, attr_id : str=None, value : DataType = None, element : etree.Element = None):
         self.id = attr_id
         self.value = value
@@ -145,11 +426,23 @@ class LsxAttribute:
         self = LsxAttribute()
         self.element = e
         self.id = e.get('id')
-        type_name = e.get('type')
-        value_string = e.get('value')
-        data_type = lookup_type(type_name)
-        self.value = data_type.fromstring(value_string)
+        self.value = parse_value(e, lookup_type(e.get('type')))
         return self
 
     def to_etree_element(self):
-        return etree.Element("attribute", id=self.id, type=self.value.NAME, value = self.value.tostring())
+        element = etree.Element("attribute", id=self.id, type=self.value.NAME, **self.value.element_attributes())
+        arguments = getattr(self.value, "arguments", None)
+        if arguments is not None:
+            element.append(deepcopy(arguments))
+        return element
+
+def parse_attributes(node : etree.Element) -> dict[str, LsxAttribute]:
+    """Parses all <attribute> children of a node at once, by id"""
+    result = {}
+    table = DATA_TYPE_LOOKUP_TABLE
+    for e in node.iterchildren("attribute"):
+        get = e.get
+        type_name = get('type')
+        data_type = table.get(type_name) or Unknown_DataType(type_name)
+        result[get('id')] = LsxAttribute(get('id'), parse_value(e, data_type), e)
+    return result
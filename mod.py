@@ -1,20 +1,55 @@
 import io, os
+import stat
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from lxml import etree
 import pak
 import lsx_attribute
+import lsf
 from copy import deepcopy
-import re
+from scan_cache import ScanCache
+from load_order import BASE_MODULE_UUID
+import instrumentation
+from typing import List
 
 xmlparser = etree.XMLParser(remove_blank_text = True)
 
 class ModInfo:
     META_ATTRIBUTES = ["Folder", "Name", "UUID", "MD5", "Version", "Version64"]
-    def __init__(self, module_info_element : etree.Element):
+    def __init__(self, module_info_element : etree.Element, dependencies : List[str] | None = None):
         self.element = module_info_element
-        self.attributes : Dist[str, lsx_attribute.LsxAttribute] = {}
-        for e in self.element.findall('./attribute'):
-            attr = lsx_attribute.LsxAttribute.from_etree_element(e)
-            self.attributes[attr.id] = attr
+        self.attributes : dict[str, lsx_attribute.LsxAttribute] = lsx_attribute.parse_attributes(self.element)
+        uuid = self.attributes.get("UUID")
+        self.uuid : str | None = uuid.value.tostring().lower() if uuid is not None and uuid.value.value is not None else None
+        # UUIDs of the mods this one depends on, from the Dependencies node of its meta.lsx
+        self.dependencies : List[str] = dependencies or []
+
+    def from_record(attributes, dependencies : List[str] | None = None):
+        """Creates a ModInfo from the [id, type, value] attribute list of a scan record(see scan_pak)"""
+        element = etree.Element("node", id="ModuleInfo")
+        for attr_id, type_name, value in attributes:
+            attribute = etree.SubElement(element, "attribute", id=attr_id, type=type_name)
+            if value is not None:
+                attribute.set("value", value)
+        return ModInfo(element, dependencies)
+
+    def name(self) -> str | None:
+        name = self.attributes.get("Name")
+        return name.value.tostring() if name is not None else None
+
+    def version(self) -> int:
+        """Version64(or the older 32 bit Version) of the mod, 0 if it has none"""
+        for attr in ("Version64", "Version"):
+            a = self.attributes.get(attr)
+            if a is not None and isinstance(a.value.value, int):
+                return a.value.value
+        return 0
+
+    def to_record(self):
+        """The META_ATTRIBUTES of the mod as a json serializable [id, type, value] list"""
+        return [[a.id, a.value.NAME, a.value.tostring()] for a in self.attributes.values() if a.id in self.META_ATTRIBUTES]
 
     def to_meta_element(self):
         meta_element = etree.Element("node", id="ModuleShortDesc")
@@ -32,93 +67,373 @@ class ModMetaLsx:
         self.mods : List[ModInfo] = []
 
         try:
-            self.root = etree.fromstring(meta_file.read(), parser = xmlparser)
+            # FileReader.read() may hand out a memoryview into a memory mapped package
+            self.root = instrumentation.timed("mod.parse.meta", ModMetaLsx.parse, xml_string)
         except:
             raise Exception(f"meta.lsx is not a valid xml file")
-        self.info = self.root.findall("./region[@id='Config']/node[@id='root']/children/node[@id='ModuleInfo']")
+        # the root node is called "root" in .lsx files, but is named after its region in converted .lsf files
+        self.info = self.root.findall("./region[@id='Config']/node/children/node[@id='ModuleInfo']")
         if not self.info:
             raise Exception(f"meta.lsx does not contain module info")
         for info_elem in self.info:
-            self.mods.append(ModInfo(info_elem))
+            dependencies = info_elem.getparent().findall("./node[@id='Dependencies']/children/node[@id='ModuleShortDesc']/attribute[@id='UUID']")
+            self.mods.append(ModInfo(info_elem, [d.get('value').lower() for d in dependencies if d.get('value')]))
+
+    def parse(data):
+        """Parses the contents of a meta.lsx file, or of its binary counterpart meta.lsf"""
+        data = bytes(data)
+        if data[:4] == lsf.LSF_MAGIC:
+            return lsf.LsfResource(data).to_etree()
+        return etree.fromstring(data, parser = xmlparser)
 
 
 class ModSettingsLsx:
-    def __init__(self, file : io.IOBase):
-        self.file = file
+    """
+    modsettings.lsx, the list of active mods of a profile.
+
+    mods maps the UUIDs of the active mods to their ModuleShortDesc nodes, in load order. All operations keep the base game module(BASE_MODULE_UUID) active.
+    ModuleShortDesc nodes without a UUID are not in mods and are left untouched.
+
+    file: path of the modsettings.lsx or a binary file object. save_file() can only replace the file atomically if it knows its path.
+    """
+    def __init__(self, file : io.IOBase | str):
+        if isinstance(file, (str, os.PathLike)):
+            self.file = None
+            self.path = os.fspath(file)
+        else:
+            self.file = file
+            name = getattr(file, "name", None)
+            self.path = name if isinstance(name, str) and os.path.isfile(name) else None
         self.tree : etree = None
         self.root : Element = None
         self.mod_elems : Element = None
-        self.mods : List[ModInfo] = []
+        self.mods : dict[str, ModInfo] = {}
 
         try:
-            self.tree = etree.parse(file, parser = xmlparser)
+            self.tree = instrumentation.timed("mod.parse.modsettings", etree.parse, file, xmlparser)
+        except OSError:
+            raise
         except:
             raise Exception(f"modsettings.lsx is not a valid xml file")
         self.root = self.tree.getroot()
         self.mod_elems = self.root.find("./region[@id='ModuleSettings']/node[@id='root']/children/node[@id='Mods']/children")
+        # taken before dropping duplicates, so that the cleaned up list counts as modified
+        self.saved_state = self.mod_list_state()
         for e in self.mod_elems.findall('./node[@id="ModuleShortDesc"]'):
-            self.mods.append(ModInfo(e))
+            mod = ModInfo(e)
+            if mod.uuid is None:
+                # not a mod we can manage, leave it alone
+                continue
+            if mod.uuid in self.mods:
+                # a mod can only be loaded once, drop duplicate entries
+                self.mod_elems.remove(e)
+                continue
+            self.mods[mod.uuid] = mod
+
+    def mod_list_state(self):
+        """Whitespace independent summary of the mod list, used to detect whether it changed since the file was loaded or saved"""
+        return [(e.get('id'), [(a.get('id'), a.get('type'), a.get('value')) for a in e.iter('attribute')]) for e in self.mod_elems]
+
+    def is_modified(self) -> bool:
+        return self.mod_list_state() != self.saved_state
+
+    def update_mod(self, active : ModInfo, mod : ModInfo):
+        """Updates the ModuleShortDesc node of an active mod with the META_ATTRIBUTES of mod, reusing the existing attribute nodes"""
+        existing = {e.get('id') : e for e in active.element.findall('./attribute')}
+        changed = False
+        for attr_id in ModInfo.META_ATTRIBUTES:
+            a = mod.attributes.get(attr_id)
+            if a is None:
+                continue
+            new_element = a.to_etree_element()
+            e = existing.get(attr_id)
+            if e is None:
+                active.element.append(new_element)
+                changed = True
+            elif e.get('type') != new_element.get('type') or e.get('value') != new_element.get('value'):
+                e.set('type', new_element.get('type'))
+                value = new_element.get('value')
+                if value is not None:
+                    e.set('value', value)
+                else:
+                    e.attrib.pop('value', None)
+                changed = True
+        if changed:
+            self.mods[mod.uuid] = ModInfo(active.element)
 
     def add_mod(self, mod : ModInfo):
-        self.mod_elems.append(mod.to_meta_element())
+        """Activates mod at the end of the load order. If it is already active, its entry is updated in place."""
+        active = self.mods.get(mod.uuid)
+        if active is not None:
+            self.update_mod(active, mod)
+            return
+        element = mod.to_meta_element()
+        self.mod_elems.append(element)
+        self.mods[mod.uuid] = ModInfo(element)
 
-    def remove_mod(self, mod : ModInfo):
-        for m in self.mods:
-            if mod.attributes["UUID"] == m.attributes["UUID"]:
-                self.mod_elems.remove(m.element)
-                self.mods.remove(m)
+    def remove_mod(self, mod : ModInfo | str):
+        """Deactivates a mod, given as ModInfo or UUID"""
+        uuid = mod.uuid if isinstance(mod, ModInfo) else mod.lower()
+        if uuid == BASE_MODULE_UUID:
+            return
+        active = self.mods.pop(uuid, None)
+        if active is not None:
+            self.mod_elems.remove(active.element)
 
     def remove_all_mods(self):
-        for mod in self.mods:
-            if mod.attributes['UUID'].value.value != "28ac9ce2-2aba-8cda-b3b5-6e922f71b6b8":
-                self.remove_mod(mod)
+        self.set_active([])
+
+    def enable(self, mods):
+        """Activates all mods(ModInfo objects), appending the new ones in the given order. Mods that are already active keep their position."""
+        for mod in mods:
+            self.add_mod(mod)
+
+    def disable(self, uuids):
+        """Deactivates all mods with the given UUIDs"""
+        for uuid in uuids:
+            self.remove_mod(uuid)
+
+    def set_active(self, mods):
+        """
+        Makes exactly the given mods active, in the given order, after the base game module.
+
+        mods may contain ModInfo objects or UUIDs of mods that are already active. The nodes of mods that stay active are reused.
+        """
+        order : dict[str, ModInfo] = {}
+        base = self.mods.get(BASE_MODULE_UUID)
+        if base is not None:
+            order[BASE_MODULE_UUID] = base
+        for mod in mods:
+            if isinstance(mod, ModInfo):
+                uuid = mod.uuid
+                if uuid in order:
+                    continue
+                active = self.mods.get(uuid)
+                if active is not None:
+                    self.update_mod(active, mod)
+                    order[uuid] = self.mods[uuid]
+                else:
+                    order[uuid] = ModInfo(mod.to_meta_element())
+            else:
+                uuid = mod.lower()
+                if uuid in order:
+                    continue
+                active = self.mods.get(uuid)
+                if active is None:
+                    raise KeyError(f"Mod {mod} is not active, pass its ModInfo to activate it")
+                order[uuid] = active
+        for active in self.mods.values():
+            if active.uuid not in order:
+                self.mod_elems.remove(active.element)
+        # appending an element that is already a child moves it, so this only reorders the existing nodes
+        for mod in order.values():
+            self.mod_elems.append(mod.element)
+        self.mods = order
+
+    def save_file(self, force : bool = False) -> bool:
+        """
+        Writes the settings back if the mod list changed since they were loaded or last saved(or if force is set). Returns whether the file was written.
 
-    def save_file(self):
+        If the path of the file is known, the new contents are written to a temporary file next to it that then replaces the original, so
+        a crash never leaves a truncated profile behind. Otherwise the file object is rewritten in place.
+        """
+        if not force and not self.is_modified():
+            return False
+        instrumentation.timed("mod.save", self.write_file)
+        self.saved_state = self.mod_list_state()
+        return True
+
+    def write_file(self):
         etree.indent(self.tree, space='    ')
-        self.file.seek(0)
-        self.file.truncate()
-        self.tree.write(self.file, pretty_print=True, xml_declaration=True, encoding='utf-8')
-#        print(etree.tostring(self.mod_elems, pretty_print=True).decode())
- #       print(etree.tostring(mod.to_meta_element(), pretty_print=True).decode())
-#    def remove_mod(self, mod : ModInfo):
-#        for m in self.mods:
-#            if m.attribute
+        if self.path is None:
+            self.file.seek(0)
+            self.file.truncate()
+            self.tree.write(self.file, pretty_print=True, xml_declaration=True, encoding='utf-8')
+            self.file.flush()
+            return
+        # replace the file a symlink points to, not the symlink itself
+        path = os.path.realpath(self.path)
+        directory, name = os.path.split(path)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{name}.", suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self.tree.write(f, pretty_print=True, xml_declaration=True, encoding='utf-8')
+                f.flush()
+                os.fsync(f.fileno())
+            try:
+                os.chmod(tmp_path, stat.S_IMODE(os.stat(path).st_mode))
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def scan_pak(path : str):
+    """
+    Reads the mod information from a .pak file into a json serializable record:
+
+    md5 - hex md5 from the package header
+    package - summary of the header and file table
+    mods - one {"meta_file", "attributes", "dependencies"} dict per ModuleInfo, see ModInfo.to_record
+    """
+    stats = instrumentation.current
+    if stats is not None:
+        stats.count("mod.paks_scanned")
+    with open(path, 'rb') as f:
+        package = pak.PackageReader(f)
+        record = {
+                "md5": bytes(package.header.md5).hex(),
+                "package": {
+                    "version": package.header.version,
+                    "flags": package.flags,
+                    "priority": package.header.priority,
+                    "num_files": len(package.files),
+                },
+                "mods": [],
+            }
+        for meta_file in package.glob("Mods/*/meta.ls[xf]"):
+            meta = ModMetaLsx(meta_file.read())
+            for mod in meta.mods:
+                record["mods"].append({"meta_file": meta_file.info.name, "attributes": mod.to_record(), "dependencies": mod.dependencies})
+        package.close()
+    return record
+
+class ScanResult:
+    """Outcome of scanning one pak: either a record(see scan_pak) or an error message"""
+    def __init__(self, path : str, record : dict | None = None, error : str | None = None, cached : bool = False):
+        self.path : str = path
+        self.record : dict | None = record
+        self.error : str | None = error
+        self.cached : bool = cached
+
+    def mods(self):
+        """ModInfo objects for all mods found in the pak"""
+        if self.record is None:
+            return []
+        return [ModInfo.from_record(m["attributes"], m["dependencies"]) for m in self.record["mods"]]
+
+def scan_worker(path : str):
+    """Scans one pak, returning (stat, scanned_ns, record, error) so that failures do not abort the rest of the batch"""
+    try:
+        pak_stat = os.stat(path)
+        scanned_ns = time.time_ns()
+        return pak_stat, scanned_ns, scan_pak(path), None
+    except Exception as e:
+        return None, None, None, f"{type(e).__name__}: {e}"
+
+def scan_paks(paths : List[str], cache : ScanCache | None = None, workers : int | None = None, use_processes : bool = False) -> List[ScanResult]:
+    """
+    Scans paks in parallel and returns one ScanResult per path, in the order of paths.
+
+    Paks with a valid cache entry are not opened. The rest are scanned on a pool of workers(default: one per CPU); threads work well since
+    lz4 and zlib release the GIL, use_processes moves the XML parsing to separate processes as well.
+    """
+    results : List[ScanResult | None] = [None] * len(paths)
+    pending : List[int] = []
+    for i, path in enumerate(paths):
+        record = None
+        if cache is not None:
+            try:
+                record = cache.lookup(path)
+            except OSError as e:
+                results[i] = ScanResult(path, error=f"{type(e).__name__}: {e}")
+                continue
+        if record is not None:
+            results[i] = ScanResult(path, record, cached=True)
+            if instrumentation.current is not None:
+                instrumentation.current.count("mod.cache_hits")
+        else:
+            pending.append(i)
+
+    workers = workers or os.cpu_count() or 1
+    if workers <= 1 or len(pending) <= 1:
+        scanned = map(scan_worker, [paths[i] for i in pending])
+        executor = None
+    else:
+        executor_type = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        executor = executor_type(max_workers=min(workers, len(pending)))
+        scanned = executor.map(scan_worker, [paths[i] for i in pending])
+    try:
+        for i, (pak_stat, scanned_ns, record, error) in zip(pending, scanned):
+            results[i] = ScanResult(paths[i], record, error)
+            if cache is not None and record is not None:
+                cache.store(paths[i], pak_stat, scanned_ns, record)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return results
 
-        
 
 if __name__ == "__main__":
     import argparse
+    import load_order
     parser = argparse.ArgumentParser(description='Create modsetting entry for mod')
-    parser.add_argument('modsettings', type=argparse.FileType('rb+'))
-    parser.add_argument('modfile', type=argparse.FileType('rb'), nargs='+')
+    parser.add_argument('modsettings')
+    parser.add_argument('modfile', nargs='*')
+    parser.add_argument('--cache', help="location of the scan cache(default: $XDG_CACHE_HOME/witchbolt/scan_cache.json)")
+    parser.add_argument('--no-cache', action='store_true', help="scan every pak, without reading or writing the scan cache")
+    parser.add_argument('--rebuild-cache', action='store_true', help="ignore cached scan results and rescan every pak")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="number of paks scanned in parallel(default: number of CPUs)")
+    parser.add_argument('--processes', action='store_true', help="scan paks in separate processes instead of threads")
+    parser.add_argument('--keep-order', action='store_true', help="activate the mods in the given order instead of sorting them by their dependencies")
+    parser.add_argument('--dump', action='store_true', help="print the resulting modsettings.lsx")
+    parser.add_argument('--watch', metavar='DIR', help="keep running and sync modsettings with the .pak files in DIR as they are added, updated or removed")
+    parser.add_argument('--interval', type=float, default=2.0, help="seconds between two checks of the --watch directory(default: 2)")
+    parser.add_argument('--stats', action='store_true', help="print I/O, decompression and parsing statistics to stderr when done(work done in --processes workers is not included)")
     args = parser.parse_args()
+    if not args.modfile and not args.watch:
+        parser.error("give at least one modfile or --watch DIR")
+    if args.stats:
+        instrumentation.enable()
     modfiles = args.modfile
     modsettings = args.modsettings
-    settings = ModSettingsLsx(modsettings)
-
-    print('removing all mods')
-    settings.remove_all_mods()
+    cache = None if args.no_cache else ScanCache(args.cache, rebuild=args.rebuild_cache)
 
-    for modfile in modfiles:
-        print(f'Reading {modfile.name}')
-        package = pak.PackageReader(modfile)
+    if modfiles:
+        settings = ModSettingsLsx(modsettings)
 
-        meta_files = [f for f in package.files if re.fullmatch("Mods/([^/]+)/meta.lsx", f.info.name)]
-        #print(meta_files)
-        for meta_file in meta_files:
-            print(f"Reading meta file {meta_file.info.name}")
-         #   print(meta_file.info.name)
-            meta = ModMetaLsx(meta_file.read())
-            etree.indent(meta.root, space='    ')
-          #  print(etree.tostring(meta.root, pretty_print=True).decode())
-            for e in meta.info:
-                modinfo = ModInfo(e)
+        mods = []
+        for result in scan_paks(modfiles, cache, workers=args.jobs, use_processes=args.processes):
+            if result.error is not None:
+                print(f"Error while reading {result.path}: {result.error}")
+                continue
+            if result.cached:
+                print(f'Using cached scan of {result.path}')
+            else:
+                print(f'Read {result.path}')
+            for modinfo in result.mods():
                 print(f"enabling mod {modinfo.attributes['Name'].value.value}")
-                settings.add_mod(modinfo)
+                mods.append(modinfo)
+        if not args.keep_order:
+            resolved = load_order.resolve(mods)
+            for problem in resolved.problems():
+                print(f"Warning: {problem}")
+            mods = resolved.order
+        settings.set_active(mods)
+
+        if cache is not None:
+            cache.save()
 
+        if args.dump:
+            print(etree.tostring(settings.root, pretty_print=True).decode())
+        if settings.save_file():
+            print(f"Wrote {modsettings}")
+        else:
+            print(f"{modsettings} is already up to date")
 
-    print(etree.tostring(settings.root, pretty_print=True).decode())
-    settings.save_file()
+    if args.watch:
+        import watch
+        watcher = watch.ModsWatcher(modsettings, args.watch, cache, workers=args.jobs, use_processes=args.processes, interval=args.interval)
+        print(f"Watching {args.watch}, press Ctrl+C to stop")
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+    if args.stats:
+        print(instrumentation.current.report(), file=sys.stderr)
 
 """
         for i, f in enumerate(files):
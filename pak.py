@@ -4,12 +4,24 @@ This file provides an interface for Larian Studios' .pak files, which are used f
 
 
 import io, os
+import hashlib
+import bisect
+import collections
+import mmap
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import lz4.block
 import lz4.frame
 import zlib
 import enum
+from collections.abc import Sequence
 from ctypes import *
 from typing import List
+import instrumentation
+
+LZ4_FRAME_MAGIC = b"\x04\x22\x4d\x18"
 
 class CompressionMethod(enum.Enum):
     NONE = 0
@@ -22,6 +34,28 @@ class Flags(enum.IntEnum):
     PRELOAD = 0x8
 
 
+class LSPKHeader13(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("version", c_uint32),
+            ("file_list_offset", c_uint32),
+            ("file_list_size", c_uint32),
+            ("num_parts", c_uint16),
+            ("flags", c_uint8),
+            ("priority", c_uint8),
+            ("md5", c_byte*16)
+        ]
+class FileEntry13(LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+            ("name", c_char*256),
+            ("offset_in_file", c_uint32),
+            ("size_on_disk", c_uint32),
+            ("uncompressed_size", c_uint32),
+            ("archive_part", c_uint32),
+            ("flags", c_uint32),
+            ("crc", c_uint32)
+        ]
 class LSPKHeader15(LittleEndianStructure):
     _pack_ = 1
     _fields_ = [
@@ -70,26 +104,44 @@ class FileEntry18(LittleEndianStructure):
 class PackagedFileInfo:
     """Describes a file inside a .pak file"""
     def __init__(self):
-        selfname: str
+        self.name : str
         self.archive_part : int
         self.crc : None | int
         self.flags : int
         self.offset_in_file : int
         self.size_on_disk : int
         self.uncompressed_size : int
-        # TODO: support solid file entries(as far as I understand, this means that all files are compressed at once rather than individually - only seems to be done for V13)
+        # offset of the file inside the decompressed solid block for files in solid archives(where all files are compressed at once - only done for V13), None otherwise
+        self.solid_offset : int | None = None
 
     def get_compression_method(self):
         compression_flag = self.flags & 0xF
         try:
             return CompressionMethod(compression_flag)
-        except TypeError:
+        except ValueError:
             raise ValueError(f"Unsupported compression method(flags=0x{compression_flag:x})")
 
-    def from_file_entry_15(buf : bytes):
+    def get_uncompressed_size(self) -> int:
+        """Length of the uncompressed contents. Stored files may have an uncompressed size of 0, their size on disk is used for them."""
+        if self.uncompressed_size == 0 and self.solid_offset is None and self.get_compression_method() == CompressionMethod.NONE:
+            return self.size_on_disk
+        return self.uncompressed_size
+
+    def from_file_entry_13(entry : FileEntry13, name : str | None = None, solid_offset : int | None = None):
+        self = PackagedFileInfo()
+        self.name = name if name is not None else entry.name.decode()
+        self.offset_in_file = entry.offset_in_file
+        self.size_on_disk = entry.size_on_disk
+        self.uncompressed_size = entry.uncompressed_size
+        self.archive_part = entry.archive_part
+        self.flags = entry.flags
+        self.crc = entry.crc
+        self.solid_offset = solid_offset
+        return self
+
+    def from_file_entry_15(entry : FileEntry15, name : str | None = None):
         self = PackagedFileInfo()
-        entry = FileEntry15.from_buffer_copy(buf)
-        self.name = c_char_p(entry.name).value.decode()
+        self.name = name if name is not None else entry.name.decode()
         self.offset_in_file = entry.offset_in_file
         self.size_on_disk = entry.size_on_disk
         self.uncompressed_size = entry.uncompressed_size
@@ -98,10 +150,9 @@ class PackagedFileInfo:
         self.crc = entry.crc
         return self
 
-    def from_file_entry_18(buf : bytes):
+    def from_file_entry_18(entry : FileEntry18, name : str | None = None):
         self = PackagedFileInfo()
-        entry = FileEntry18.from_buffer_copy(buf)
-        self.name = c_char_p(entry.name).value.decode()
+        self.name = name if name is not None else entry.name.decode()
         self.offset_in_file = entry.offset_in_file_1 + (entry.offset_in_file_2 << 32)
         self.size_on_disk = entry.size_on_disk
         self.uncompressed_size = entry.uncompressed_size
@@ -111,20 +162,193 @@ class PackagedFileInfo:
         return self
 
 
+class FileTable:
+    """
+    Columnar view of a decompressed file list.
+
+    The entries are a single ctypes array on top of the decompressed buffer, PackagedFileInfo objects are only created for the entries that are accessed.
+    """
+    def __init__(self, entry_type, num_files : int, file_list : bytearray):
+        self.entry_type = entry_type
+        self.buffer : bytearray = file_list
+        self.entries = (entry_type * num_files).from_buffer(file_list)
+        self._names : List[str] | None = None
+        self.solid_offsets : List[int] | None = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def names(self) -> List[str]:
+        """Decodes the names of all entries in one pass. The result is cached."""
+        if self._names is None:
+            self._names = instrumentation.timed("pak.names", lambda: [e.name.decode() for e in self.entries])
+        return self._names
+
+    def name(self, index : int) -> str:
+        if self._names is not None:
+            return self._names[index]
+        return self.entries[index].name.decode()
+
+    def info(self, index : int) -> PackagedFileInfo:
+        name = self._names[index] if self._names is not None else None
+        if self.entry_type is FileEntry18:
+            return PackagedFileInfo.from_file_entry_18(self.entries[index], name)
+        if self.entry_type is FileEntry13:
+            solid_offset = self.solid_offsets[index] if self.solid_offsets is not None else None
+            return PackagedFileInfo.from_file_entry_13(self.entries[index], name, solid_offset)
+        return PackagedFileInfo.from_file_entry_15(self.entries[index], name)
+
+    def empty():
+        return FileTable(FileEntry18, 0, bytearray())
+
+
+def glob_to_regex(pattern : str) -> str:
+    """
+    Translates a glob pattern over package paths into a regular expression.
+
+    "*" and "?" do not match across "/", "**/" matches any number of directories(including none), a trailing "**" everything below and "[...]" is a character class.
+    """
+    result = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            # zero or more directories
+            result.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            result.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            result.append("[^/]*")
+        elif c == "?":
+            result.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 2 if pattern.startswith("[!", i) else i + 1)
+            if end == -1:
+                result.append(re.escape(c))
+            else:
+                body = pattern[i+1:end]
+                if body.startswith("!"):
+                    body = "^" + body[1:]
+                result.append(f"[{body}]")
+                i = end
+        else:
+            result.append(re.escape(c))
+        i += 1
+    return "".join(result)
+
+
+class NameIndex:
+    """
+    Hash and sorted index over the paths of a package.
+
+    Maps every name to its position in the file list(later duplicates win) and keeps the names sorted, so that directory listings and globs only look at the matching range of names.
+    """
+    def __init__(self, names : List[str]):
+        self.positions : dict[str, int] = {name : i for i, name in enumerate(names)}
+        self.sorted_names : List[str] = sorted(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, name):
+        return name in self.positions
+
+    def get(self, name : str) -> int | None:
+        return self.positions.get(name)
+
+    def prefixed(self, prefix : str) -> List[str]:
+        """All names starting with prefix, in sorted order"""
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        # chr(0x10ffff) sorts after every character that can follow the prefix
+        end = bisect.bisect_left(self.sorted_names, prefix + "\U0010ffff", start)
+        return self.sorted_names[start:end]
+
+    def glob(self, pattern : str) -> List[str]:
+        """Names matching the glob pattern(see glob_to_regex), in sorted order"""
+        literal_end = len(pattern)
+        for special in "*?[":
+            pos = pattern.find(special)
+            if pos != -1:
+                literal_end = min(literal_end, pos)
+        if literal_end == len(pattern):
+            return [pattern] if pattern in self.positions else []
+        regex = re.compile(glob_to_regex(pattern))
+        return list(filter(regex.fullmatch, self.prefixed(pattern[:literal_end])))
+
+    def match(self, regex : str | re.Pattern) -> List[str]:
+        """Names fully matching the regular expression, in sorted order"""
+        return list(filter(re.compile(regex).fullmatch, self.sorted_names))
+
+    def listdir(self, directory : str = "") -> List[str]:
+        """
+        Immediate children of directory, in sorted order. Subdirectories are returned with a trailing "/".
+
+        Whole subdirectories are skipped with a bisection, so this costs one step per child rather than one per name below directory.
+        """
+        prefix = directory.rstrip("/") + "/" if directory.strip("/") else ""
+        names = self.sorted_names
+        children = []
+        i = bisect.bisect_left(names, prefix)
+        while i < len(names) and names[i].startswith(prefix):
+            child, sep, _ = names[i][len(prefix):].partition("/")
+            if sep:
+                children.append(child + "/")
+                # "0" is the character right after "/", so this skips everything inside the subdirectory
+                i = bisect.bisect_left(names, prefix + child + "0", i)
+            else:
+                children.append(child)
+                i += 1
+        return children
+
+
+class FileList(Sequence):
+    """Lazy sequence of FileReaders over the FileTable of a package"""
+    def __init__(self, package : "PackageReader", table : FileTable):
+        self.package : PackageReader = package
+        self.table : FileTable = table
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self.table)
+        if not 0 <= index < len(self.table):
+            raise IndexError("file index out of range")
+        return FileReader(self.table.info(index), self.package)
+
+
 class FileReader:
-    def __init__(self, file_info : PackagedFileInfo, pak_file : io.IOBase):
-        self.info : PackedFileInfo = file_info
-        self.pak_file : io.IOBase = pak_file
+    def __init__(self, file_info : PackagedFileInfo, package : "PackageReader"):
+        self.info : PackagedFileInfo = file_info
+        self.package : PackageReader = package
 
     def read(self):
-        off = self.pak_file.seek(self.info.offset_in_file)
-        if off != self.info.offset_in_file:
-            raise EOFError()
-        compressed_data = self.pak_file.read(self.info.size_on_disk)
-        if len(compressed_data) != self.info.size_on_disk:
-            raise EOFError()
+        """
+        Returns the uncompressed contents of the file.
+
+        For stored(uncompressed) files inside a memory mapped package and for files in solid archives, this is a memoryview into the mapping or
+        the decompressed solid block rather than a copy.
+        """
+        if self.info.solid_offset is not None:
+            block = self.package.read_solid_block()
+            if self.info.solid_offset + self.info.uncompressed_size > len(block):
+                raise EOFError()
+            return memoryview(block)[self.info.solid_offset:self.info.solid_offset + self.info.uncompressed_size]
+        return self.decompress(self.package.read_range(self.info.offset_in_file, self.info.size_on_disk, self.info.archive_part))
 
+    def decompress(self, compressed_data):
+        """Decompresses the raw on-disk data of the file(as returned by PackageReader.read_range)"""
         compression_method = self.info.get_compression_method()
+        stats = instrumentation.current
+        if stats is not None:
+            start = time.perf_counter()
 
         match compression_method:
             case CompressionMethod.NONE:
@@ -132,11 +356,24 @@ class FileReader:
             case CompressionMethod.ZLIB:
                 uncompressed_data = self.decompress_zlib(compressed_data)
             case CompressionMethod.LZ4:
-                uncompressed_data = self.decompress_lz4(compressed_data)
+                # a block can never start with the frame magic, since its first sequence cannot be a match
+                uncompressed_data = self.decompress_lz4(compressed_data, chunked = bytes(compressed_data[:4]) == LZ4_FRAME_MAGIC)
+        if stats is not None and compression_method != CompressionMethod.NONE:
+            method_name = compression_method.name.lower()
+            stats.add_time(f"pak.decompress.{method_name}", time.perf_counter() - start)
+            stats.count(f"pak.bytes_decompressed.{method_name}", len(uncompressed_data))
         if (compression_method != CompressionMethod.NONE) and (len(uncompressed_data) != self.info.uncompressed_size):
             raise Exception(f"Uncompressed file length does not match expected value({len(uncompressed_data)} instead of {self.info.uncompressed_size})")
         return uncompressed_data
     
+    def open(self, chunk_size : int = 64*1024):
+        """
+        Returns a readable file object for the uncompressed contents, see EntryStream.
+
+        Unlike read(), this decompresses incrementally and reads the package in chunks of chunk_size, so memory use does not depend on the size of the file.
+        """
+        return EntryStream(self, chunk_size)
+
     def decompress_zlib(self, compressed_data):
         data = zlib.decompress(compressed_data)
         return data
@@ -149,21 +386,362 @@ class FileReader:
 
 
 
+class EntryStream(io.RawIOBase):
+    """
+    Raw stream over the uncompressed contents of a packaged file.
+
+    Stored files are read straight from the package and are cheaply seekable. ZLIB files and LZ4 frames are decompressed incrementally,
+    seeking in them decompresses up to the target(from the start when seeking backwards). LZ4 blocks cannot be decoded incrementally,
+    so they are decompressed as a whole on first read. Files in solid archives are served from the cached solid block.
+    """
+    def __init__(self, file : FileReader, chunk_size : int = 64*1024):
+        super().__init__()
+        self.file : FileReader = file
+        self.info : PackagedFileInfo = file.info
+        self.chunk_size : int = chunk_size
+        self.method : CompressionMethod = self.info.get_compression_method()
+        self.size : int = self.info.get_uncompressed_size()
+        self.pos : int = 0
+        self.reset()
+
+    def reset(self):
+        """Restarts decompression from the beginning of the file"""
+        self.pos = 0
+        self.src_pos : int = 0
+        self.decompressor = None
+        self.block : bytes | None = None
+        if self.info.solid_offset is not None:
+            self.block = self.file.read()
+        elif self.method == CompressionMethod.ZLIB:
+            self.decompressor = zlib.decompressobj()
+        elif self.method == CompressionMethod.LZ4:
+            if bytes(self.read_source(4)) == LZ4_FRAME_MAGIC:
+                self.decompressor = lz4.frame.LZ4FrameDecompressor()
+            self.src_pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def read_source(self, size : int):
+        size = min(size, self.info.size_on_disk - self.src_pos)
+        data = self.file.package.read_range(self.info.offset_in_file + self.src_pos, size, self.info.archive_part)
+        self.src_pos += size
+        return data
+
+    def readinto(self, b):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        match self.method:
+            case _ if self.block is not None:
+                data = self.block[self.pos:self.pos+n]
+            case CompressionMethod.NONE:
+                data = self.file.package.read_range(self.info.offset_in_file + self.pos, n, self.info.archive_part)
+            case CompressionMethod.ZLIB:
+                data = instrumentation.timed("pak.decompress.zlib", self.read_zlib, n, count="pak.bytes_decompressed.zlib")
+            case CompressionMethod.LZ4 if self.decompressor is not None:
+                data = instrumentation.timed("pak.decompress.lz4", self.read_lz4_frame, n, count="pak.bytes_decompressed.lz4")
+            case CompressionMethod.LZ4:
+                self.block = self.file.read()
+                data = self.block[self.pos:self.pos+n]
+        if len(data) == 0:
+            raise Exception(f"Uncompressed file length does not match expected value({self.pos} instead of {self.size})")
+        b[:len(data)] = data
+        self.pos += len(data)
+        return len(data)
+
+    def read_zlib(self, n : int):
+        while True:
+            if self.decompressor.unconsumed_tail:
+                data = self.decompressor.decompress(self.decompressor.unconsumed_tail, n)
+            elif self.src_pos < self.info.size_on_disk:
+                data = self.decompressor.decompress(self.read_source(self.chunk_size), n)
+            else:
+                return self.decompressor.flush()[:n]
+            if data or self.decompressor.eof:
+                return data
+
+    def read_lz4_frame(self, n : int):
+        while True:
+            if not self.decompressor.needs_input:
+                data = self.decompressor.decompress(b"", n)
+            elif self.src_pos < self.info.size_on_disk:
+                data = self.decompressor.decompress(self.read_source(self.chunk_size), n)
+            else:
+                return b""
+            if data or self.decompressor.eof:
+                return data
+
+    def seek(self, offset : int, whence : int = io.SEEK_SET):
+        match whence:
+            case io.SEEK_SET:
+                target = offset
+            case io.SEEK_CUR:
+                target = self.pos + offset
+            case io.SEEK_END:
+                target = self.size + offset
+            case _:
+                raise ValueError(f"invalid whence({whence})")
+        if target < 0:
+            raise ValueError(f"negative seek position {target}")
+        target = min(target, self.size)
+        if self.method == CompressionMethod.NONE or self.block is not None:
+            self.pos = target
+            return self.pos
+        if target < self.pos:
+            self.reset()
+        scratch = bytearray(min(self.chunk_size, target - self.pos))
+        while self.pos < target:
+            self.readinto(memoryview(scratch)[:target - self.pos])
+        return self.pos
+
+    def close(self):
+        self.decompressor = None
+        self.block = None
+        super().close()
+
+
+class BlockCache:
+    """
+    Size bounded LRU cache of decompressed solid blocks.
+
+    Each block is decompressed only once while it stays cached, even if several threads ask for it at the same time. A single block larger than max_size is still kept until the next block is loaded.
+    Several PackageReaders can share one cache.
+    """
+    def __init__(self, max_size : int = 256*1024*1024):
+        self.max_size : int = max_size
+        self.size : int = 0
+        self.blocks : collections.OrderedDict = collections.OrderedDict()
+        self.loading : dict = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """Returns the block cached under key, calling load() to decompress it if it is not cached"""
+        with self.lock:
+            block = self.blocks.get(key)
+            if block is not None:
+                self.blocks.move_to_end(key)
+                return block
+            key_lock = self.loading.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                block = self.blocks.get(key)
+                if block is not None:
+                    self.blocks.move_to_end(key)
+                    return block
+            block = load()
+            with self.lock:
+                self.blocks[key] = block
+                self.size += len(block)
+                while self.size > self.max_size and len(self.blocks) > 1:
+                    _, evicted = self.blocks.popitem(last=False)
+                    self.size -= len(evicted)
+                self.loading.pop(key, None)
+        return block
+
+    def clear(self):
+        with self.lock:
+            self.blocks.clear()
+            self.size = 0
+
+
+class PartHandle:
+    __slots__ = ("file", "signature", "checked", "users", "stale", "lock")
+
+    def __init__(self, file):
+        self.file = file
+        self.signature : tuple = PartPool.signature(os.fstat(file.fileno()))
+        # time.monotonic() of the last check of the signature against the file at the path
+        self.checked : float = time.monotonic()
+        self.users : int = 0
+        # set once the part was replaced, the handle is closed as soon as its last reader is done
+        self.stale : bool = False
+        self.lock = threading.Lock()
+
+
+class PartPool:
+    """
+    Bounded LRU pool of open file handles for the additional parts of multi-part packages.
+
+    Parts are opened on first use and stay open for later reads, but at most max_open handles are kept. The least recently used
+    idle handle is closed when a new part is opened, handles that are currently being read from are never closed.
+    A handle taken from the pool more than check_interval seconds after its last check stats the part, if the file was replaced or
+    modified since it was opened the handle is dropped and the part reopened. Use invalidate() to have changes picked up right away.
+    """
+    def __init__(self, max_open : int = 16, check_interval : float = 1.0):
+        self.max_open : int = max_open
+        self.check_interval : float = check_interval
+        self.handles : collections.OrderedDict = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def signature(stat : os.stat_result) -> tuple:
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def read_range(self, path : str, offset : int, size : int):
+        with self.lock:
+            handle = self.handles.get(path)
+            if handle is not None:
+                now = time.monotonic()
+                if now - handle.checked > self.check_interval:
+                    handle.checked = now
+                    try:
+                        replaced = PartPool.signature(os.stat(path)) != handle.signature
+                    except FileNotFoundError:
+                        replaced = True
+                    if replaced:
+                        self.discard(path, handle)
+                        handle = None
+            if handle is None:
+                handle = PartHandle(open(path, 'rb'))
+                self.handles[path] = handle
+            else:
+                self.handles.move_to_end(path)
+            handle.users += 1
+            self.evict()
+        try:
+            if hasattr(os, "pread"):
+                data = os.pread(handle.file.fileno(), size, offset)
+            else:
+                with handle.lock:
+                    handle.file.seek(offset)
+                    data = handle.file.read(size)
+        finally:
+            with self.lock:
+                handle.users -= 1
+                if handle.stale and handle.users == 0:
+                    handle.file.close()
+                self.evict()
+        if len(data) != size:
+            raise EOFError()
+        return data
+
+    def invalidate(self, path : str | None = None):
+        """Drops the handle of the part at path(or of all parts), so that it is reopened by the next read"""
+        with self.lock:
+            for handle_path, handle in list(self.handles.items()):
+                if path is None or handle_path == path:
+                    self.discard(handle_path, handle)
+
+    def discard(self, path : str, handle : PartHandle):
+        # must be called with self.lock held
+        del self.handles[path]
+        if handle.users == 0:
+            handle.file.close()
+        else:
+            handle.stale = True
+
+    def evict(self):
+        # must be called with self.lock held
+        if len(self.handles) <= self.max_open:
+            return
+        for path, handle in list(self.handles.items()):
+            if len(self.handles) <= self.max_open:
+                break
+            if handle.users == 0:
+                handle.file.close()
+                del self.handles[path]
+
+    def close(self):
+        """Closes all idle handles"""
+        with self.lock:
+            for path, handle in list(self.handles.items()):
+                if handle.users == 0:
+                    handle.file.close()
+                    del self.handles[path]
+
+default_part_pool = PartPool()
+
+
+def bounded_map(fn, items, cost, budget : int, workers : int | None = None):
+    """
+    Like Executor.map on a thread pool, but only pulls the next item from items once the summed cost(item) of the items in flight fits into budget.
+
+    items is consumed lazily in the calling thread, so it can do sequential reads while the pool does the heavy lifting. Results are yielded in order.
+    """
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        pending = collections.deque()
+        in_flight = 0
+        for item in items:
+            item_cost = cost(item)
+            while pending and in_flight + item_cost > budget:
+                future, future_cost = pending.popleft()
+                in_flight -= future_cost
+                yield future.result()
+            pending.append((executor.submit(fn, item), item_cost))
+            in_flight += item_cost
+        while pending:
+            future, _ = pending.popleft()
+            yield future.result()
+
+def extract_path(dest : str, name : str) -> str:
+    """Path below dest to extract the packaged file name to. Refuses names that would end up outside of dest."""
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or ".." in parts or os.path.isabs(name) or os.path.splitdrive(parts[0])[0]:
+        raise ValueError(f"Refusing to extract {name} outside of {dest}")
+    return os.path.join(dest, *parts)
+
+
+class VerifyResult:
+    """Outcome of PackageReader.verify()"""
+    def __init__(self, quick : bool):
+        self.quick : bool = quick
+        self.files_checked : int = 0
+        self.bytes_checked : int = 0
+        # whether the package checksum from the header was compared
+        self.md5_checked : bool = False
+        # (name of the file or None for the package itself, description of the problem)
+        self.problems : List[tuple[str | None, str]] = []
+
+    def ok(self) -> bool:
+        return not self.problems
+
+    def add(self, name : str | None, message : str):
+        self.problems.append((name, message))
+
 
 class PackageReader:
     MAGIC = b"LSPK"
 
-    def __init__(self, package):
+    def __init__(self, package, use_mmap : bool | None = None, load_file_list : bool = True, block_cache : BlockCache | None = None, part_pool : "PartPool | None" = None):
+        """
+        package: a binary file object positioned anywhere
+        use_mmap: memory map the package for zero-copy reads. None(the default) maps only packages flagged with Flags.ALLOW_MEMORY_MAPPING.
+        load_file_list: if False, only the header is read and files stays empty
+        block_cache: cache for the decompressed data of solid archives, e.g. to share one between packages. By default each package gets its own.
+        part_pool: pool of file handles for the additional parts(Foo_1.pak, Foo_2.pak, ...) of multi-part packages. Defaults to the shared default_part_pool.
+        """
         self.package : io.IOBase = package
-        self.files : List[FileReader] = []
+        self.table : FileTable = FileTable.empty()
+        self.files : FileList = FileList(self, self.table)
+        self.index : NameIndex | None = None
         self.flags : int = 0
         self.header = None
+        self.use_mmap : bool | None = use_mmap
+        self.load_file_list : bool = load_file_list
+        self.mmap : mmap.mmap | None = None
+        self.view : memoryview | None = None
+        self.fileno : int | None = None
+        self.lock = threading.Lock()
+        self.block_cache : BlockCache = block_cache or BlockCache()
+        self.part_pool : PartPool = part_pool or default_part_pool
+        # (offset, size, uncompressed size) of the compressed solid block
+        self.solid_block : tuple | None = None
+        # identifies this package in a shared block cache
+        self.cache_token = object()
 
         # first check for v13 headers, which are always at the end of the file
         package.seek(-4, io.SEEK_END)
         signature = package.read(4)
         if signature == self.MAGIC:
-            raise Exception("V13 not supported")
+            self.read_v13()
             return
         package.seek(0)
         signature = package.read(4)
@@ -184,83 +762,668 @@ class PackageReader:
         # TODO: handle V7 and V9
         raise Exception("Version not supported or not a valid pak file")
 
-    def read_file_list_15(self):
-        self.package.seek(self.header.file_list_offset)
-        num_files = c_uint32.from_buffer_copy(package.read(4)).value
-        compressed_file_list_size = c_uint32.from_buffer_copy(self.package.read(4)).value
-        compressed_file_list = package.read(compressed_file_list_size)
-        file_list_size = num_files*sizeof(FileEntry15)
-        file_list = lz4.block.decompress(compressed_file_list, uncompressed_size = file_list_size)
+    def open_backend(self):
+        """
+        Sets up positionless access to the package data, so that several readers(or threads) can share it without fighting over the file position.
+
+        Uses a read only memory mapping if requested, falls back to pread and finally to seek+read under a lock for file objects without a file descriptor.
+        """
+        try:
+            self.fileno = self.package.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            self.fileno = None
+        if self.fileno is None:
+            return
+        if self.use_mmap or (self.use_mmap is None and self.flags & Flags.ALLOW_MEMORY_MAPPING):
+            try:
+                self.mmap = mmap.mmap(self.fileno, 0, access=mmap.ACCESS_READ)
+                self.view = memoryview(self.mmap)
+            except (OSError, ValueError):
+                # empty or unmappable file(e.g. a pipe), just use regular reads
+                self.mmap = None
+                self.view = None
+        if not hasattr(os, "pread"):
+            self.fileno = None
+
+    def part_path(self, part : int) -> str:
+        """Path of an additional part of a multi-part package, e.g. Foo_1.pak for part 1 of Foo.pak"""
+        name = getattr(self.package, "name", None)
+        if not isinstance(name, str):
+            raise Exception(f"Can not locate part {part} of a package that was not opened from a file")
+        base, ext = os.path.splitext(name)
+        return f"{base}_{part}{ext}"
+
+    def read_range(self, offset : int, size : int, part : int = 0):
+        """
+        Returns size bytes starting at offset in the given part of the package.
+
+        This is a memoryview into the mapping if the main part is memory mapped. Additional parts are opened on demand through the part pool.
+        """
+        stats = instrumentation.current
+        if stats is None:
+            return self.read_range_uninstrumented(offset, size, part)
+        with stats.timer("pak.read"):
+            data = self.read_range_uninstrumented(offset, size, part)
+        stats.count("pak.bytes_read", size)
+        return data
+
+    def read_range_uninstrumented(self, offset : int, size : int, part : int = 0):
+        if part != 0:
+            return self.part_pool.read_range(self.part_path(part), offset, size)
+        if self.view is not None:
+            if offset + size > len(self.view):
+                raise EOFError()
+            return self.view[offset:offset+size]
+        if self.fileno is not None:
+            data = os.pread(self.fileno, size, offset)
+        else:
+            with self.lock:
+                if self.package.seek(offset) != offset:
+                    raise EOFError()
+                data = self.package.read(size)
+        if len(data) != size:
+            raise EOFError()
+        return data
+
+    def copy_range(self, offset : int, size : int, out_fd : int) -> bool:
+        """
+        Copies size bytes starting at offset to out_fd inside the kernel(copy_file_range or sendfile), so the data never passes through python.
+
+        Returns False without writing anything if that is not possible for this package or platform.
+        """
+        try:
+            in_fd = self.package.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return False
+        copied = 0
+        for copy in ("copy_file_range", "sendfile"):
+            if not hasattr(os, copy):
+                continue
+            try:
+                while copied < size:
+                    if copy == "copy_file_range":
+                        n = os.copy_file_range(in_fd, out_fd, size - copied, offset + copied)
+                    else:
+                        n = os.sendfile(out_fd, in_fd, offset + copied, size - copied)
+                    if n == 0:
+                        raise EOFError()
+                    copied += n
+                if instrumentation.current is not None:
+                    instrumentation.current.count("pak.bytes_copied", size)
+                return True
+            except OSError:
+                # e.g. copy_file_range across file systems on older kernels, try the next method from where this one stopped
+                continue
+        if copied:
+            # whatever was copied already sits at the start of out_fd
+            os.write(out_fd, self.read_range(offset + copied, size - copied))
+            return True
+        return False
+
+    def extract_all(self, dest : str, include : str | List[str] | None = None, workers : int | None = None, max_in_flight : int = 64*1024*1024) -> List[str]:
+        """
+        Extracts the files of the package below dest and returns the paths written.
+
+        include: glob pattern(s) selecting the files to extract, see glob(). By default everything is extracted.
+        workers: size of the thread pool decompressing and writing files(default: one per CPU)
+        max_in_flight: bound on the compressed plus uncompressed bytes of files read but not yet written
+
+        Files are read in the order they are stored in the package to keep disk access sequential. Stored files in the main part are copied inside the kernel where possible.
+        """
+        if include is None:
+            positions = range(len(self.files))
+        else:
+            index = self.get_index()
+            patterns = [include] if isinstance(include, str) else include
+            positions = sorted({index.get(name) for pattern in patterns for name in index.glob(pattern)})
+        files = sorted((self.files[i] for i in positions), key=lambda f: (f.info.archive_part, f.info.offset_in_file))
+        paths = [extract_path(dest, f.info.name) for f in files]
+        for directory in {os.path.dirname(p) for p in paths}:
+            os.makedirs(directory, exist_ok=True)
+
+        def jobs():
+            for file, path in zip(files, paths):
+                if file.info.solid_offset is not None:
+                    # served from the cached solid block
+                    yield file, path, None
+                    continue
+                if file.info.get_compression_method() == CompressionMethod.NONE:
+                    with open(path, 'wb') as out:
+                        if file.info.archive_part == 0 and self.copy_range(file.info.offset_in_file, file.info.size_on_disk, out.fileno()):
+                            continue
+                yield file, path, self.read_range(file.info.offset_in_file, file.info.size_on_disk, file.info.archive_part)
+
+        def extract(job):
+            file, path, compressed_data = job
+            data = file.read() if compressed_data is None else file.decompress(compressed_data)
+            with open(path, 'wb') as out:
+                out.write(data)
+
+        for _ in bounded_map(extract, jobs(), lambda job: job[0].info.size_on_disk + job[0].info.uncompressed_size, max_in_flight, workers):
+            pass
+        return paths
+
+    def read_many(self, files, max_gap : int = 64*1024, max_read : int = 8*1024*1024, workers : int | None = None, max_in_flight : int = 64*1024*1024):
+        """
+        Reads several files at once and yields (FileReader, uncompressed data) pairs in the order the files are stored in the package.
+
+        files: paths, FileReaders or PackagedFileInfos of files of this package
+        max_gap: files whose data is at most this many bytes apart are fetched with a single read, the bytes in between are read and dropped
+        max_read: upper bound on the size of a merged read(a larger single file is still read at once)
+        workers: size of the thread pool decompressing the files(default: one per CPU, 1 decompresses in the calling thread)
+        max_in_flight: bound on the compressed plus uncompressed bytes of files read but not yet yielded
+
+        Like FileReader.read(), stored files may be returned as memoryviews, here into the buffer of the merged read.
+        """
+        readers = []
+        for file in files:
+            if isinstance(file, str):
+                file = self.open(file)
+            elif isinstance(file, PackagedFileInfo):
+                file = FileReader(file, self)
+            readers.append(file)
+        solid = [f for f in readers if f.info.solid_offset is not None]
+        solid.sort(key=lambda f: f.info.solid_offset)
+        stored = [f for f in readers if f.info.solid_offset is None]
+        stored.sort(key=lambda f: (f.info.archive_part, f.info.offset_in_file))
+
+        def runs():
+            """Groups of files that are read with a single read_range call"""
+            run = []
+            for file in stored:
+                info = file.info
+                file_end = info.offset_in_file + info.size_on_disk
+                if run:
+                    first = run[0].info
+                    if (info.archive_part != first.archive_part or info.offset_in_file - end > max_gap
+                            or max(end, file_end) - first.offset_in_file > max_read):
+                        yield run, end
+                        run = []
+                if not run:
+                    end = file_end
+                run.append(file)
+                end = max(end, file_end)
+            if run:
+                yield run, end
+
+        def jobs():
+            """Batches of (file, compressed data) pairs, so that the pool is not handed single small files"""
+            if solid:
+                yield [(file, None) for file in solid]
+            stats = instrumentation.current
+            for run, end in runs():
+                start = run[0].info.offset_in_file
+                data = memoryview(self.read_range(start, end - start, run[0].info.archive_part))
+                if stats is not None:
+                    stats.count("pak.read_many.reads")
+                    stats.count("pak.read_many.files", len(run))
+                batch = []
+                batch_size = 0
+                for file in run:
+                    offset = file.info.offset_in_file - start
+                    batch.append((file, data[offset:offset + file.info.size_on_disk]))
+                    batch_size += file.info.size_on_disk + file.info.uncompressed_size
+                    if batch_size >= batch_budget:
+                        yield batch
+                        batch = []
+                        batch_size = 0
+                if batch:
+                    yield batch
+
+        def read(batch):
+            return [(file, file.read() if compressed_data is None else file.decompress(compressed_data)) for file, compressed_data in batch]
+
+        def cost(batch):
+            return sum(file.info.size_on_disk + file.info.uncompressed_size for file, _ in batch)
+
+        batch_budget = min(256*1024, max_in_flight)
+        if workers == 1:
+            results = map(read, jobs())
+        else:
+            results = bounded_map(read, jobs(), cost, max_in_flight, workers)
+        for batch in results:
+            yield from batch
+
+    def part_size(self, part : int) -> int:
+        if part != 0:
+            return os.path.getsize(self.part_path(part))
+        if self.fileno is not None:
+            return os.fstat(self.fileno).st_size
+        if self.view is not None:
+            return len(self.view)
+        with self.lock:
+            return self.package.seek(0, io.SEEK_END)
+
+    def verify(self, quick : bool = False, workers : int | None = None, max_in_flight : int = 64*1024*1024) -> VerifyResult:
+        """
+        Checks the package for damage and returns the problems found.
+
+        quick: only check that every file has a known compression method, lies inside its part(or the solid block) and has consistent sizes.
+               Nothing but the header and file list is read.
+        Otherwise every file is also read and decompressed on a pool of workers, checking the CRC of the stored data where the entry has one
+        and the decompressed size. If the header has a checksum(non-zero md5), the package checksum is compared too. max_in_flight bounds the
+        compressed plus uncompressed bytes held at once.
+        """
+        result = VerifyResult(quick)
+        part_sizes : dict[int, int | None] = {}
+        def part_size(part):
+            if part not in part_sizes:
+                try:
+                    part_sizes[part] = self.part_size(part)
+                except OSError:
+                    part_sizes[part] = None
+            return part_sizes[part]
+
+        if self.solid_block is not None:
+            offset, size, uncompressed_size = self.solid_block
+            if part_size(0) is not None and offset + size > part_size(0):
+                result.add(None, "Solid block extends past the end of the package")
+
+        files = []
+        for file in self.files:
+            info = file.info
+            problems = len(result.problems)
+            try:
+                method = info.get_compression_method()
+            except ValueError as e:
+                result.add(info.name, str(e))
+                continue
+            if info.solid_offset is not None:
+                if info.solid_offset + info.uncompressed_size > self.solid_block[2]:
+                    result.add(info.name, "File extends past the end of the solid block")
+            else:
+                size = part_size(info.archive_part)
+                if size is None:
+                    result.add(info.name, f"Part {info.archive_part} is missing or can not be opened")
+                elif info.offset_in_file + info.size_on_disk > size:
+                    result.add(info.name, f"File extends past the end of part {info.archive_part}")
+                if method == CompressionMethod.NONE and info.uncompressed_size not in (0, info.size_on_disk):
+                    result.add(info.name, f"Stored file has size {info.size_on_disk} but uncompressed size {info.uncompressed_size}")
+            if len(result.problems) == problems:
+                files.append(file)
+        result.files_checked = len(self.files)
+        if quick:
+            return result
+
+        md5 = bytes(getattr(self.header, "md5", b""))
+        check_md5 = any(md5) and len(files) == len(self.files)
+        if check_md5:
+            # the checksum covers the uncompressed files in file list order, sorted by name before V15
+            if self.header.version < 15:
+                files.sort(key=lambda f: f.info.name)
+            package_hash = hashlib.md5()
+        else:
+            files.sort(key=lambda f: (f.info.archive_part, f.info.offset_in_file))
+
+        def jobs():
+            for file in files:
+                if file.info.solid_offset is not None:
+                    yield file, None
+                    continue
+                try:
+                    yield file, self.read_range(file.info.offset_in_file, file.info.size_on_disk, file.info.archive_part)
+                except (OSError, EOFError) as e:
+                    yield file, e
+
+        def check(job):
+            file, raw = job
+            info = file.info
+            problems = []
+            data = None
+            try:
+                if isinstance(raw, Exception):
+                    raise raw
+                if raw is None:
+                    data = file.read()
+                else:
+                    if info.crc and zlib.crc32(raw) != info.crc:
+                        problems.append(f"CRC mismatch(0x{zlib.crc32(raw):08x} instead of 0x{info.crc:08x})")
+                    data = file.decompress(raw)
+                    if info.get_compression_method() == CompressionMethod.NONE and info.uncompressed_size and len(data) != info.uncompressed_size:
+                        problems.append(f"File length does not match expected value({len(data)} instead of {info.uncompressed_size})")
+            except Exception as e:
+                problems.append(f"{type(e).__name__}: {e}")
+            return file, data if check_md5 else None, problems
+
+        for file, data, problems in bounded_map(check, jobs(), lambda job: job[0].info.size_on_disk + job[0].info.uncompressed_size, max_in_flight, workers):
+            result.bytes_checked += file.info.size_on_disk
+            for problem in problems:
+                result.add(file.info.name, problem)
+            if check_md5:
+                if data is None:
+                    check_md5 = False
+                else:
+                    package_hash.update(data)
+        if check_md5:
+            result.md5_checked = True
+            # LSLib increments every byte of the digest by one
+            digest = bytes((b + 1) & 0xff for b in package_hash.digest())
+            if digest != md5:
+                result.add(None, f"Package checksum mismatch({digest.hex()} instead of {md5.hex()})")
+        return result
+
+    def close(self):
+        """Releases the memory mapping, if any. The package file itself is owned by the caller."""
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # memoryviews returned by FileReader.read() are still alive, the mapping goes away together with the last of them
+                pass
+            self.mmap = None
+
+    def get_index(self) -> NameIndex:
+        """Returns the name index of the package, building it on first use"""
+        if self.index is None:
+            self.index = NameIndex(self.table.names())
+        return self.index
+
+    def __contains__(self, name : str):
+        return name in self.get_index()
+
+    def find(self, name : str) -> FileReader | None:
+        """Returns the FileReader for the file with the given path, or None if the package does not contain it"""
+        position = self.get_index().get(name)
+        if position is None:
+            return None
+        return self.files[position]
+
+    def open(self, name : str) -> FileReader:
+        """Returns the FileReader for the file with the given path"""
+        file = self.find(name)
+        if file is None:
+            raise FileNotFoundError(f"{name} not found in package")
+        return file
+
+    def glob(self, pattern : str) -> List[FileReader]:
+        """FileReaders for all files matching the glob pattern, e.g. "Mods/*/meta.lsx". "*" does not match "/", "**" does."""
+        index = self.get_index()
+        return [self.files[index.get(name)] for name in index.glob(pattern)]
+
+    def match(self, regex : str | re.Pattern) -> List[FileReader]:
+        """FileReaders for all files whose path fully matches the regular expression"""
+        index = self.get_index()
+        return [self.files[index.get(name)] for name in index.match(regex)]
+
+    def listdir(self, directory : str = "") -> List[str]:
+        """Names of the files and subdirectories(with a trailing "/") directly inside directory"""
+        return self.get_index().listdir(directory)
+
+    def read_solid_block(self):
+        """Returns the decompressed solid block of a solid archive, decompressing it only if it is not in the block cache"""
+        if self.solid_block is None:
+            raise Exception("Package is not a solid archive")
+        offset, size, uncompressed_size = self.solid_block
+
+        def load():
+            decompressor = lz4.frame.LZ4FrameDecompressor()
+            compressed_block = self.read_range(offset, size)
+            block = instrumentation.timed("pak.decompress.solid", decompressor.decompress, compressed_block, count="pak.bytes_decompressed.solid")
+            if len(block) != uncompressed_size:
+                raise Exception(f"Solid block length does not match expected value({len(block)} instead of {uncompressed_size})")
+            return block
+        return self.block_cache.get((self.cache_token, offset), load)
+
+    def read_file_list(self, entry_type):
+        file_list_header = self.read_range(self.header.file_list_offset, 8)
+        num_files = c_uint32.from_buffer_copy(file_list_header, 0).value
+        compressed_file_list_size = c_uint32.from_buffer_copy(file_list_header, 4).value
+        compressed_file_list = self.read_range(self.header.file_list_offset + 8, compressed_file_list_size)
+        self.set_file_list(entry_type, num_files, compressed_file_list)
+
+    def set_file_list(self, entry_type, num_files : int, compressed_file_list):
+        file_list_size = num_files*sizeof(entry_type)
+        stats = instrumentation.current
+        if stats is not None:
+            start = time.perf_counter()
+        file_list = lz4.block.decompress(compressed_file_list, uncompressed_size = file_list_size, return_bytearray = True)
         if len(file_list) != file_list_size:
             raise Exception("Incorrect file list length")
+        if stats is not None:
+            stats.add_time("pak.file_list", time.perf_counter() - start)
+            stats.count("pak.entries_decoded", num_files)
+
+        self.table = FileTable(entry_type, num_files, file_list)
+        self.files = FileList(self, self.table)
+        self.index = None
 
-        for i in range(0, num_files):
-            entry = PackagedFileInfo.from_file_entry_15(file_list[i*sizeof(FileEntry15):(i+1)*sizeof(FileEntry15)])
-            self.files.append(FileReader(entry, self.package))
+    def read_file_list_13(self):
+        num_files = c_uint32.from_buffer_copy(self.read_range(self.header.file_list_offset, 4)).value
+        compressed_file_list = self.read_range(self.header.file_list_offset + 4, self.header.file_list_size - 4)
+        self.set_file_list(FileEntry13, num_files, compressed_file_list)
+        if self.flags & Flags.SOLID and num_files:
+            self.read_solid_layout()
+
+    def read_solid_layout(self):
+        """
+        Solid archives store all files as a single LZ4 frame starting at the beginning of the package. The file list describes
+        how the compressed frame(after its 7 byte header) is split up, the files are laid out in the same order in the decompressed block.
+        """
+        offset = 7
+        uncompressed_size = 0
+        solid_offsets = []
+        for entry in self.table.entries:
+            if entry.offset_in_file != offset:
+                raise Exception("File list in solid archive not contiguous")
+            solid_offsets.append(uncompressed_size)
+            offset += entry.size_on_disk
+            uncompressed_size += entry.uncompressed_size
+        self.table.solid_offsets = solid_offsets
+        self.solid_block = (0, offset, uncompressed_size)
+
+    def read_file_list_15(self):
+        self.read_file_list(FileEntry15)
 
     def read_file_list_18(self):
-        self.package.seek(self.header.file_list_offset)
-        num_files = c_uint32.from_buffer_copy(self.package.read(4)).value
-        compressed_file_list_size = c_uint32.from_buffer_copy(self.package.read(4)).value
-        compressed_file_list = self.package.read(compressed_file_list_size)
-        file_list_size = num_files*sizeof(FileEntry18)
-        file_list = lz4.block.decompress(compressed_file_list, uncompressed_size = file_list_size)
-        if len(file_list) != file_list_size:
-            raise Exception("Incorrect file list length")
+        self.read_file_list(FileEntry18)
 
-        for i in range(0, num_files):
-            entry = PackagedFileInfo.from_file_entry_18(file_list[i*sizeof(FileEntry18):(i+1)*sizeof(FileEntry18)])
-            self.files.append(FileReader(entry, self.package))
+    def read_v13(self):
+        self.package.seek(-8, io.SEEK_END)
+        header_size = c_uint32.from_buffer_copy(self.package.read(4)).value
+        self.package.seek(-header_size, io.SEEK_END)
+        self.header = LSPKHeader13.from_buffer_copy(self.package.read(sizeof(LSPKHeader13)))
+        if self.header.version != 13:
+            raise Exception(f"V{self.header.version} not supported")
+        self.flags = self.header.flags
+        self.open_backend()
+
+        if self.load_file_list:
+            self.read_file_list_13()
 
     def read_v15(self):
         self.package.seek(4)
         self.header = LSPKHeader15.from_buffer_copy(self.package.read(sizeof(LSPKHeader15)))
         self.flags = self.header.flags
+        self.open_backend()
 
-        self.read_file_list_15()
+        if self.load_file_list:
+            self.read_file_list_15()
 
     def read_v16(self):
         self.package.seek(4)
         self.header = LSPKHeader16.from_buffer_copy(self.package.read(sizeof(LSPKHeader16)))
         self.flags = self.header.flags
+        self.open_backend()
 
-        self.read_file_list_15()
+        if self.load_file_list:
+            self.read_file_list_15()
 
     def read_v18(self):
         self.package.seek(4)
         self.header = LSPKHeader16.from_buffer_copy(self.package.read(sizeof(LSPKHeader16)))
         self.flags = self.header.flags
+        self.open_backend()
 
-        self.read_file_list_18()
-        """
-        num_files = c_uint32.from_buffer_copy(package.read(4)).value
-        compressed_file_list_size = c_uint32.from_buffer_copy(package.read(4)).value
-        compressed_file_list = package.read(compressed_file_list_size)
-        file_list_size = num_files*sizeof(FileEntry18)
-        file_list = lz4.block.decompress(compressed_file_list, uncompressed_size = file_list_size)
-        if len(file_list) != file_list_size:
-            raise Exception("Incorrect file list length")
+        if self.load_file_list:
+            self.read_file_list_18()
+
+def hash_stored(file : FileReader, chunk_size : int = 1024*1024) -> bytes:
+    """md5 of the on-disk(possibly compressed) data of a file, read in chunks"""
+    info = file.info
+    digest = hashlib.md5()
+    for offset in range(0, info.size_on_disk, chunk_size):
+        digest.update(file.package.read_range(info.offset_in_file + offset, min(chunk_size, info.size_on_disk - offset), info.archive_part))
+    return digest.digest()
+
+def hash_contents(file : FileReader, chunk_size : int = 1024*1024) -> bytes:
+    """md5 of the uncompressed contents of a file, decompressed incrementally"""
+    digest = hashlib.md5()
+    with file.open(chunk_size) as stream:
+        while chunk := stream.read(chunk_size):
+            digest.update(chunk)
+    return digest.digest()
+
+def diff_packages(old : PackageReader, new : PackageReader, include_unchanged : bool = False, workers : int | None = None, max_in_flight : int = 64*1024*1024):
+    """
+    Compares the files of two packages and yields one json serializable dict per added, removed or modified file, in name order:
+
+    {"name": ..., "change": "added" | "removed" | "modified" | "unchanged", "by": "metadata" | "stored" | "contents"}
+
+    "by" tells how a change was found(or ruled out) and is missing for added and removed files. Entries are first compared by their file
+    list metadata. Only if that is not conclusive(equal sizes but no CRC to compare, a different compression method or solid archives),
+    the stored data is hashed and, if that differs but could still decompress to the same contents, the uncompressed contents. Those
+    hashes are computed on a pool of workers.
+    """
+    old_positions = old.get_index().positions
+    new_positions = new.get_index().positions
+    names = sorted(old_positions.keys() | new_positions.keys())
+
+    def classify(name : str):
+        """Returns a finished change dict, or (old file, new file) if their data has to be compared"""
+        old_position = old_positions.get(name)
+        new_position = new_positions.get(name)
+        if old_position is None:
+            return {"name": name, "change": "added"}
+        if new_position is None:
+            return {"name": name, "change": "removed"}
+        old_info = old.table.info(old_position)
+        new_info = new.table.info(new_position)
+        if old_info.get_uncompressed_size() != new_info.get_uncompressed_size():
+            return {"name": name, "change": "modified", "by": "metadata"}
+        solid = old_info.solid_offset is not None or new_info.solid_offset is not None
+        if not solid and old_info.flags & 0xF == new_info.flags & 0xF and old_info.crc and new_info.crc:
+            # the CRCs cover the stored data, for the same compression method they are conclusive
+            unchanged = old_info.crc == new_info.crc and old_info.size_on_disk == new_info.size_on_disk
+            return {"name": name, "change": "unchanged" if unchanged else "modified", "by": "metadata"}
+        return FileReader(old_info, old), FileReader(new_info, new)
+
+    def compare(pair):
+        old_file, new_file = pair
+        old_info, new_info = old_file.info, new_file.info
+        name = new_info.name
+        solid = old_info.solid_offset is not None or new_info.solid_offset is not None
+        same_method = old_info.flags & 0xF == new_info.flags & 0xF
+        if not solid and same_method and old_info.size_on_disk == new_info.size_on_disk:
+            if hash_stored(old_file) == hash_stored(new_file):
+                return {"name": name, "change": "unchanged", "by": "stored"}
+            if new_info.get_compression_method() == CompressionMethod.NONE:
+                return {"name": name, "change": "modified", "by": "stored"}
+        unchanged = hash_contents(old_file) == hash_contents(new_file)
+        return {"name": name, "change": "unchanged" if unchanged else "modified", "by": "contents"}
+
+    def cost(pair):
+        return pair[0].info.size_on_disk + pair[1].info.size_on_disk
+
+    classified = [classify(name) for name in names]
+    compared = bounded_map(compare, (c for c in classified if isinstance(c, tuple)), cost, max_in_flight, workers)
+    for change in classified:
+        if isinstance(change, tuple):
+            # results of the pool come in the same order as the pairs were submitted
+            change = next(compared)
+        if include_unchanged or change["change"] != "unchanged":
+            yield change
 
-        for i in range(0, num_files):
-            entry = PackagedFileInfo.from_file_entry_18(file_list[i*sizeof(FileEntry18):(i+1)*sizeof(FileEntry18)])
-            self.files.append(FileReader(entry, package))
-        """
 
 if __name__ == "__main__":
     import argparse
-    parser = argparse.ArgumentParser(description='Create modsetting entry for mod')
-    parser.add_argument('package', nargs="+", type=argparse.FileType('rb'))
-    args = parser.parse_args()
-    packages = args.package
-
-    for package in packages:
-        print("\n")
-        print(package.name)
-        try:
-            reader = PackageReader(package)
-        except Exception as e:
-            print(f"Error while reading file {package.name} : {e}")
-            continue
-        for file in reader.files:
-            print(file.info.name)
-            #print(file.read())
+    import sys
+    parser = argparse.ArgumentParser(description='Inspect and extract .pak files')
+    parser.add_argument('--mmap', action=argparse.BooleanOptionalAction, default=None, help="memory map packages(default: only packages that allow it)")
+    parser.add_argument('--stats', action='store_true', help="print I/O and decompression statistics to stderr when done")
+    commands = parser.add_subparsers(dest='command', required=True)
+    list_parser = commands.add_parser('list', help="list the files inside packages")
+    list_parser.add_argument('package', nargs="+", type=argparse.FileType('rb'))
+    extract_parser = commands.add_parser('extract', help="extract the files of a package")
+    extract_parser.add_argument('package', type=argparse.FileType('rb'))
+    extract_parser.add_argument('dest')
+    extract_parser.add_argument('--include', action='append', help="glob pattern of files to extract, e.g. 'Public/**/*.lsx'. May be given several times.")
+    extract_parser.add_argument('-j', '--jobs', type=int, default=None, help="number of files decompressed in parallel(default: number of CPUs)")
+    verify_parser = commands.add_parser('verify', help="check packages for damage")
+    verify_parser.add_argument('package', nargs="+", type=argparse.FileType('rb'))
+    verify_parser.add_argument('--quick', action='store_true', help="only check the file list against the package sizes, without reading the files")
+    verify_parser.add_argument('-j', '--jobs', type=int, default=None, help="number of files checked in parallel(default: number of CPUs)")
+    diff_parser = commands.add_parser('diff', help="list the files that differ between two packages as json lines")
+    diff_parser.add_argument('old', type=argparse.FileType('rb'))
+    diff_parser.add_argument('new', type=argparse.FileType('rb'))
+    diff_parser.add_argument('--unchanged', action='store_true', help="list unchanged files as well")
+    diff_parser.add_argument('-j', '--jobs', type=int, default=None, help="number of files hashed in parallel(default: number of CPUs)")
+    overlaps_parser = commands.add_parser('overlaps', help="report paths contained in several packages and which package provides them")
+    overlaps_parser.add_argument('package', nargs="+", type=argparse.FileType('rb'), help="packages in load order")
+    overlaps_parser.add_argument('--summary', action='store_true', help="only print the number of shadowed paths per pair of packages")
+
+    argv = sys.argv[1:]
+    if argv and not argv[0].startswith('-') and argv[0] not in commands.choices:
+        # "pak.py PAK..." used to be the only way to call this, keep it working as "list"
+        argv.insert(0, 'list')
+    args = parser.parse_args(argv)
+    if args.stats:
+        instrumentation.enable()
+
+    match args.command:
+        case 'list':
+            for package in args.package:
+                print("\n")
+                print(package.name)
+                try:
+                    reader = PackageReader(package, use_mmap=args.mmap)
+                except Exception as e:
+                    print(f"Error while reading file {package.name} : {e}")
+                    continue
+                for file in reader.files:
+                    print(file.info.name)
+        case 'extract':
+            reader = PackageReader(args.package, use_mmap=args.mmap)
+            paths = reader.extract_all(args.dest, include=args.include, workers=args.jobs)
+            print(f"Extracted {len(paths)} files to {args.dest}")
+        case 'verify':
+            damaged = 0
+            for package in args.package:
+                try:
+                    reader = PackageReader(package, use_mmap=args.mmap)
+                    result = reader.verify(quick=args.quick, workers=args.jobs)
+                except Exception as e:
+                    print(f"{package.name}: can not be read({e})")
+                    damaged += 1
+                    continue
+                if result.ok():
+                    checksum = ", package checksum ok" if result.md5_checked else ""
+                    print(f"{package.name}: OK({result.files_checked} files{checksum})")
+                else:
+                    damaged += 1
+                    for name, problem in result.problems:
+                        print(f"{package.name}: {name + ': ' if name is not None else ''}{problem}")
+                reader.close()
+            if damaged:
+                print(f"{damaged} of {len(args.package)} packages are damaged")
+                sys.exit(1)
+        case 'diff':
+            import json
+            old_reader = PackageReader(args.old, use_mmap=args.mmap)
+            new_reader = PackageReader(args.new, use_mmap=args.mmap)
+            for change in diff_packages(old_reader, new_reader, include_unchanged=args.unchanged, workers=args.jobs):
+                print(json.dumps(change, separators=(",", ":")))
+        case 'overlaps':
+            import vfs
+            union = vfs.UnionFS([PackageReader(package, use_mmap=args.mmap) for package in args.package])
+            if args.summary:
+                for (provider, shadowed), count in sorted(union.conflicts().items()):
+                    print(f"{provider} shadows {count} files of {shadowed}")
+            else:
+                for overlap in union.overlaps():
+                    shadowed = ", ".join(layer.name for layer in overlap.shadowed())
+                    print(f"{overlap.name}: {overlap.provider().name} (shadows {shadowed})")
+    if args.stats:
+        print(instrumentation.current.report(), file=sys.stderr)
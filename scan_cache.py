@@ -0,0 +1,105 @@
+"""
+Persistent cache of .pak scan results, so that mod.py does not have to reopen paks that did not change since the last run.
+
+Entries are keyed by the real path of the pak and are only reused if its size, modification time, inode and change time are unchanged.
+The inode and change time catch paks replaced by tools that preserve the modification time(cp -p, rsync -a, unzip). A pak modified within
+RACY_WINDOW_NS of being scanned could have changed again without its mtime moving(the same problem git has with "racy" index entries),
+so such entries are additionally checked against the md5 stored in the package header and rescanned if that is not conclusive.
+"""
+
+import os
+import json
+import pak
+
+CACHE_VERSION = 3
+RACY_WINDOW_NS = 2_000_000_000
+
+def default_cache_path():
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "witchbolt", "scan_cache.json")
+
+def read_header_md5(path : str) -> str:
+    with open(path, 'rb') as f:
+        package = pak.PackageReader(f, use_mmap=False, load_file_list=False)
+        return bytes(package.header.md5).hex()
+
+
+class ScanCache:
+    """
+    Maps pak paths to the json serializable records produced by mod.scan_pak.
+
+    path: location of the cache file
+    rebuild: ignore the current contents of the cache file, it is overwritten on save()
+    """
+    def __init__(self, path : str | None = None, rebuild : bool = False):
+        self.path : str = path or default_cache_path()
+        self.entries : dict[str, dict] = {}
+        self.dirty : bool = False
+        if not rebuild:
+            self.load()
+        else:
+            self.dirty = True
+
+    def load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            # missing or corrupt cache, start over
+            return
+        if not isinstance(data, dict) or data.get("version") != CACHE_VERSION:
+            return
+        self.entries = data.get("entries", {})
+
+    def key(path : str) -> str:
+        return os.path.realpath(path)
+
+    def lookup(self, path : str, stat : os.stat_result | None = None) -> dict | None:
+        """Returns the cached record for path, or None if there is none or it is no longer valid"""
+        entry = self.entries.get(ScanCache.key(path))
+        if entry is None:
+            return None
+        stat = stat or os.stat(path)
+        if (entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns or entry["ino"] != stat.st_ino
+                or entry["ctime_ns"] != stat.st_ctime_ns):
+            return None
+        if stat.st_mtime_ns + RACY_WINDOW_NS >= entry["scanned_ns"]:
+            # the pak was modified right around the time it was scanned, only trust a non-zero header checksum
+            if int(entry["md5"], 16) == 0:
+                return None
+            try:
+                if read_header_md5(path) != entry["md5"]:
+                    return None
+            except Exception:
+                return None
+        return entry["record"]
+
+    def store(self, path : str, stat : os.stat_result, scanned_ns : int, record : dict):
+        """
+        Caches the record for path.
+
+        stat and scanned_ns must be taken before the pak is read, so that modifications during the scan invalidate the entry.
+        """
+        self.entries[ScanCache.key(path)] = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "ino": stat.st_ino,
+                "ctime_ns": stat.st_ctime_ns,
+                "scanned_ns": scanned_ns,
+                "md5": record["md5"],
+                "record": record,
+            }
+        self.dirty = True
+
+    def save(self):
+        """Writes the cache if it changed. The file is replaced atomically, so concurrent runs never see a partial cache."""
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({"version": CACHE_VERSION, "entries": self.entries}, f)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
@@ -0,0 +1,140 @@
+"""
+Union view over several packages, layered the way the game loads them.
+
+Packages are ordered by the priority field of their header and then by load order(the order they are given in). When several packages
+contain the same path, the one ordered last provides it and shadows the others.
+"""
+
+from typing import List
+from pak import PackageReader, FileReader, NameIndex
+
+class Layer:
+    """One package of a UnionFS"""
+    def __init__(self, package : PackageReader, name : str, load_position : int):
+        self.package : PackageReader = package
+        self.name : str = name
+        self.priority : int = package.header.priority
+        self.load_position : int = load_position
+
+    def sort_key(self):
+        return (self.priority, self.load_position)
+
+
+class Overlap:
+    """A path contained in several layers. layers is ordered from the shadowed layers to the one providing the path."""
+    def __init__(self, name : str, layers : List[Layer]):
+        self.name : str = name
+        self.layers : List[Layer] = layers
+
+    def provider(self) -> Layer:
+        return self.layers[-1]
+
+    def shadowed(self) -> List[Layer]:
+        return self.layers[:-1]
+
+
+class UnionFS:
+    """
+    Merged file table of several packages.
+
+    packages: PackageReaders in load order
+    names: labels of the packages in reports(default: the file name of each package)
+
+    The merged table is a dict from path to layer built with one dict.update per package, so resolving a path is a single lookup.
+    """
+    def __init__(self, packages : List[PackageReader], names : List[str] | None = None):
+        self.layers : List[Layer] = []
+        for i, package in enumerate(packages):
+            name = names[i] if names is not None else getattr(package.package, "name", str(i))
+            self.layers.append(Layer(package, name, i))
+        # stable, so packages of equal priority stay in load order
+        self.layers.sort(key=Layer.sort_key)
+
+        # path -> index into layers of the layer providing it
+        self.providers : dict[str, int] = {}
+        for i, layer in enumerate(self.layers):
+            self.providers.update(dict.fromkeys(layer.package.get_index().positions, i))
+        self.index : NameIndex | None = None
+        self.overlap_map : dict[str, List[int]] | None = None
+
+    def __len__(self):
+        return len(self.providers)
+
+    def __contains__(self, name : str):
+        return name in self.providers
+
+    def get_index(self) -> NameIndex:
+        """Sorted index over all paths, built on first use"""
+        if self.index is None:
+            self.index = NameIndex(list(self.providers))
+        return self.index
+
+    def resolve(self, name : str) -> Layer | None:
+        """The layer providing name, or None if no package contains it"""
+        i = self.providers.get(name)
+        return self.layers[i] if i is not None else None
+
+    def find(self, name : str) -> FileReader | None:
+        """Returns the FileReader for the visible version of the file, or None if no package contains it"""
+        i = self.providers.get(name)
+        if i is None:
+            return None
+        return self.layers[i].package.find(name)
+
+    def open(self, name : str) -> FileReader:
+        file = self.find(name)
+        if file is None:
+            raise FileNotFoundError(f"{name} not found in any package")
+        return file
+
+    def glob(self, pattern : str) -> List[FileReader]:
+        """FileReaders for the visible versions of all files matching the glob pattern(see PackageReader.glob)"""
+        return [self.find(name) for name in self.get_index().glob(pattern)]
+
+    def listdir(self, directory : str = "") -> List[str]:
+        """Names of the files and subdirectories(with a trailing "/") directly inside directory, across all layers"""
+        return self.get_index().listdir(directory)
+
+    def layers_of(self, name : str) -> List[Layer]:
+        """All layers containing name, from shadowed to providing"""
+        overlapping = self.get_overlap_map().get(name)
+        if overlapping is not None:
+            return [self.layers[i] for i in overlapping]
+        layer = self.resolve(name)
+        return [layer] if layer is not None else []
+
+    def get_overlap_map(self) -> dict[str, List[int]]:
+        """
+        Paths contained in more than one layer -> indices of those layers, from shadowed to providing.
+
+        Each layer's names are intersected with the union of the layers before it as hashed key sets, so this is linear in the total number of paths.
+        """
+        if self.overlap_map is None:
+            overlap_map : dict[str, List[int]] = {}
+            seen : dict[str, int] = {}
+            for i, layer in enumerate(self.layers):
+                names = layer.package.get_index().positions
+                for name in names.keys() & seen.keys():
+                    overlapping = overlap_map.get(name)
+                    if overlapping is None:
+                        overlap_map[name] = [seen[name], i]
+                    else:
+                        overlapping.append(i)
+                seen.update(dict.fromkeys(names, i))
+            self.overlap_map = overlap_map
+        return self.overlap_map
+
+    def overlaps(self) -> List[Overlap]:
+        """All paths contained in more than one layer, sorted by path"""
+        overlap_map = self.get_overlap_map()
+        return [Overlap(name, [self.layers[i] for i in overlap_map[name]]) for name in sorted(overlap_map)]
+
+    def conflicts(self) -> dict[tuple[str, str], int]:
+        """(providing layer, shadowed layer) -> number of paths the first one shadows in the second"""
+        counts : dict[tuple[str, str], int] = {}
+        for overlapping in self.get_overlap_map().values():
+            provider = self.layers[overlapping[-1]].name
+            for i in overlapping[:-1]:
+                key = (provider, self.layers[i].name)
+                counts[key] = counts.get(key, 0) + 1
+        return counts
@@ -0,0 +1,180 @@
+"""
+Keeps a modsettings.lsx in sync with the .pak files in a directory(e.g. the Mods folder of the game).
+
+The directory is polled with os.scandir, which only stats its entries, so watching costs next to nothing while nothing changes. Changes
+are applied once the directory looked the same for a while, so downloads that are still being written are not scanned half finished.
+Only added or changed paks are scanned(through the scan cache), and only the mods they add or drop are enabled or disabled, so the
+rest of the profile, including mods enabled in the game, is left alone.
+"""
+
+import os
+import threading
+import time
+from typing import List
+import load_order
+from mod import ModInfo, ModSettingsLsx, scan_paks
+from scan_cache import ScanCache
+
+class ModsWatcher:
+    """
+    settings_path: the modsettings.lsx to keep in sync
+    directory: directory containing the mod .pak files
+    interval: seconds between two polls of the directory
+    settle: seconds the directory has to stay unchanged before changes are applied
+    cache, workers, use_processes: passed to scan_paks
+    log: function called with progress messages
+    """
+    def __init__(self, settings_path : str, directory : str, cache : ScanCache | None = None, workers : int | None = None,
+                 use_processes : bool = False, interval : float = 2.0, settle : float = 1.0, log = print):
+        self.settings_path : str = settings_path
+        self.directory : str = directory
+        self.cache : ScanCache | None = cache
+        self.workers : int | None = workers
+        self.use_processes : bool = use_processes
+        self.interval : float = interval
+        self.settle : float = settle
+        self.log = log
+        self.settings : ModSettingsLsx | None = None
+        self.settings_stat : tuple | None = None
+        # path -> (size, mtime_ns) of the paks as of the last sync
+        self.paks : dict[str, tuple[int, int]] = {}
+        # path -> the mods found in the pak
+        self.provided : dict[str, List[ModInfo]] = {}
+        # path -> (size, mtime_ns) of paks that could not be read, they are only scanned again once they change
+        self.failed : dict[str, tuple[int, int]] = {}
+
+    def snapshot(self) -> dict[str, tuple[int, int]]:
+        """(size, mtime_ns) of every .pak file in the directory"""
+        result = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if not entry.name.lower().endswith(".pak"):
+                        continue
+                    try:
+                        if not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        # removed while listing
+                        continue
+                    result[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        return result
+
+    def stat_settings(self) -> tuple | None:
+        try:
+            stat = os.stat(self.settings_path)
+        except FileNotFoundError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def load_settings(self) -> ModSettingsLsx:
+        """The current settings, reloaded if the file was changed by someone else(e.g. the game) since it was last read or written"""
+        stat = self.stat_settings()
+        if self.settings is None or stat != self.settings_stat:
+            self.settings = ModSettingsLsx(self.settings_path)
+            self.settings_stat = stat
+        return self.settings
+
+    def changes(self, snapshot : dict[str, tuple[int, int]]) -> tuple[List[str], List[str]]:
+        """(changed, removed) paths of snapshot compared to the last synced state. Paks that failed to scan count as settled until they change."""
+        changed = sorted(path for path, state in snapshot.items() if self.paks.get(path) != state and self.failed.get(path) != state)
+        removed = [path for path in self.paks if path not in snapshot]
+        return changed, removed
+
+    def sync(self, snapshot : dict[str, tuple[int, int]]) -> bool:
+        """
+        Applies the differences between snapshot and the last synced state. Returns whether modsettings.lsx was written.
+
+        The synced state is only updated once modsettings.lsx was written, so after an exception the same changes are applied again by the next sync.
+        """
+        self.failed = {path : state for path, state in self.failed.items() if snapshot.get(path) == state}
+        changed, removed = self.changes(snapshot)
+        if not changed and not removed:
+            return False
+        settings = self.load_settings()
+
+        for path in removed:
+            self.log(f"Removed {path}")
+        paks = dict(snapshot)
+        provided = {path : pak_mods for path, pak_mods in self.provided.items() if path not in removed}
+        failed = dict(self.failed)
+        stale = set(mod.uuid for path in removed for mod in self.provided.get(path, []))
+        mods = []
+        for result in scan_paks(changed, self.cache, workers=self.workers, use_processes=self.use_processes):
+            if result.error is not None:
+                # probably still being written. Its mods stay as they are and it is scanned again once it changes.
+                self.log(f"Error while reading {result.path}: {result.error}")
+                failed[result.path] = snapshot[result.path]
+                if result.path in self.paks:
+                    paks[result.path] = self.paks[result.path]
+                else:
+                    del paks[result.path]
+                continue
+            self.log(f"{'Using cached scan of' if result.cached else 'Read'} {result.path}")
+            failed.pop(result.path, None)
+            pak_mods = result.mods()
+            stale.update(mod.uuid for mod in provided.get(result.path, []))
+            provided[result.path] = pak_mods
+            mods.extend(pak_mods)
+
+        # mods that moved to another pak stay active
+        known = {mod.uuid : mod for pak_mods in provided.values() for mod in pak_mods}
+        disabled = [uuid for uuid in stale if uuid not in known and uuid in settings.mods]
+        for uuid in disabled:
+            self.log(f"disabling mod {settings.mods[uuid].name() or uuid}")
+        settings.disable(disabled)
+
+        # the new mods are sorted together with the active ones, so that they end up before active mods that depend on them.
+        # Only the pak entries know the dependencies, entries of mods without a pak in the directory are taken as they are.
+        scanned = {mod.uuid : mod for mod in mods}
+        active = [scanned.get(uuid) or known.get(uuid) or mod for uuid, mod in settings.mods.items()]
+        resolved = load_order.resolve(active + [mod for mod in mods if mod.uuid not in settings.mods],
+                                      available=set(settings.mods) | set(known))
+        for problem in resolved.problems():
+            self.log(f"Warning: {problem}")
+        for mod in resolved.order:
+            if mod.uuid not in settings.mods:
+                self.log(f"enabling mod {mod.name() or mod.uuid}")
+        # entries of mods from unchanged paks are kept as they are
+        settings.set_active([mod if mod.uuid in scanned else mod.uuid for mod in resolved.order])
+
+        if self.cache is not None:
+            self.cache.save()
+        written = settings.save_file()
+        if written:
+            self.settings_stat = self.stat_settings()
+            self.log(f"Wrote {self.settings_path}")
+        self.paks, self.provided, self.failed = paks, provided, failed
+        return written
+
+    def try_sync(self, snapshot : dict[str, tuple[int, int]]):
+        """sync(), logging errors instead of raising them, so that the watcher keeps running(e.g. while the game is writing modsettings.lsx)"""
+        try:
+            self.sync(snapshot)
+        except Exception as e:
+            self.log(f"Error while syncing: {type(e).__name__}: {e}")
+            # the profile may be half updated, start over from the file with the next sync
+            self.settings = None
+
+    def run(self, stop : threading.Event | None = None):
+        """Syncs once, then watches the directory until stop is set(or forever)"""
+        stop = stop or threading.Event()
+        self.try_sync(self.snapshot())
+        pending : dict | None = None
+        pending_since = 0.0
+        while not stop.wait(self.interval):
+            snapshot = self.snapshot()
+            if self.changes(snapshot) == ([], []):
+                pending = None
+                continue
+            if snapshot != pending:
+                # something changed(again), wait for the directory to settle
+                pending = snapshot
+                pending_since = time.monotonic()
+                continue
+            if time.monotonic() - pending_since >= self.settle:
+                self.try_sync(snapshot)
+                pending = None